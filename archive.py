@@ -0,0 +1,383 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import batch
+
+# Archive layout: a fixed header, the base rendering, the entries and the
+# index, each block zlib compressed. Every entry is a line delta against the
+# base (copy a run of base lines or insert literal text), compressed with the
+# end of the base as preset dictionary, so sweep variants that differ in a
+# few numbers take a few hundred bytes each. The index maps each key (the
+# spec hash of seeded engines) to its name and entry. Appending writes new
+# entries and a new index after the old one and only then points the header
+# at it, so an interrupted append leaves the archive as it was.
+
+MAGIC = b"MRARC\x00\x00\x01"
+
+# magic, base offset, base length, index offset, index length
+HEADER = struct.Struct("<8sQQQQ")
+
+COPY = struct.Struct("<BII")
+INSERT = struct.Struct("<BI")
+
+DICTIONARY_SIZE = 32 * 1024
+LEVEL = 9
+
+def text_key(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def engine_key(engine, text):
+    # Without a seed every render is different, see Engine.seed
+    return engine.spec_hash() if engine.seed is not None else text_key(text)
+
+def split_lines(text):
+    return text.splitlines(keepends=True)
+
+def line_positions(lines):
+    # First position of every distinct line
+    positions = {}
+    for position, line in enumerate(lines):
+        positions.setdefault(line, position)
+    return positions
+
+def encode_delta(base_lines, base_positions, text):
+    # Greedy O(lines) delta: a line continues the current run of base lines
+    # if it matches the next one, otherwise it starts a new run at its first
+    # occurrence in the base or becomes literal text
+    parts = []
+    literal = []
+    run_start = run_count = 0
+    expected = 0
+    n_base = len(base_lines)
+
+    for line in split_lines(text):
+        if expected < n_base and base_lines[expected] == line:
+            position = expected
+        else:
+            position = base_positions.get(line)
+
+        if position is None:
+            if run_count:
+                parts.append(COPY.pack(0, run_start, run_count))
+                run_count = 0
+            literal.append(line)
+
+            # Most likely a changed line, keep following the base
+            expected += 1
+            continue
+
+        if literal:
+            data = "".join(literal).encode("utf-8")
+            parts.append(INSERT.pack(1, len(data)))
+            parts.append(data)
+            literal = []
+
+        if run_count and run_start + run_count == position:
+            run_count += 1
+        else:
+            if run_count:
+                parts.append(COPY.pack(0, run_start, run_count))
+            run_start = position
+            run_count = 1
+        expected = position + 1
+
+    if run_count:
+        parts.append(COPY.pack(0, run_start, run_count))
+    if literal:
+        data = "".join(literal).encode("utf-8")
+        parts.append(INSERT.pack(1, len(data)))
+        parts.append(data)
+
+    return b"".join(parts)
+
+def decode_delta(base_lines, delta):
+    pieces = []
+    offset = 0
+    while offset < len(delta):
+        if delta[offset] == 0:
+            _, start, count = COPY.unpack_from(delta, offset)
+            offset += COPY.size
+            pieces.append("".join(base_lines[start:start + count]))
+        else:
+            _, length = INSERT.unpack_from(delta, offset)
+            offset += INSERT.size
+            pieces.append(delta[offset:offset + length].decode("utf-8"))
+            offset += length
+
+    return "".join(pieces)
+
+def compress(data, dictionary=None):
+    compressor = zlib.compressobj(LEVEL, zdict=dictionary) if dictionary else zlib.compressobj(LEVEL)
+    return compressor.compress(data) + compressor.flush()
+
+def decompress(data, dictionary=None):
+    decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+    return decompressor.decompress(data) + decompressor.flush()
+
+def read_header(data):
+    magic, base_offset, base_length, index_offset, index_length = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ValueError("Not an engine archive")
+    return base_offset, base_length, index_offset, index_length
+
+def read_index(data):
+    # [[key, name, offset, length, size], ...] in the order added
+    if not data:
+        return []
+    return json.loads(decompress(data).decode("utf-8"))["entries"]
+
+class Archive:
+    # Read only mapping from key to rendered text over an archive file. The
+    # file is memory mapped and only the base and the index are decoded on
+    # open, extracting a variant reads and decompresses its entry alone.
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        base_offset, base_length, index_offset, index_length = read_header(self.buffer[:HEADER.size])
+        base = decompress(self.buffer[base_offset:base_offset + base_length]) if base_length else b""
+        self.base_lines = split_lines(base.decode("utf-8"))
+        self.dictionary = base[-DICTIONARY_SIZE:]
+
+        self.entries = {}
+        self.keys_by_name = {}
+        for key, name, offset, length, size in read_index(self.buffer[index_offset:index_offset + index_length]):
+            self.entries[key] = (name, offset, length, size)
+            if name is not None:
+                self.keys_by_name[name] = key
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        name, offset, length, size = self.entries[key]
+        return decode_delta(self.base_lines, decompress(self.buffer[offset:offset + length], self.dictionary))
+
+    def get(self, key, default=None):
+        return self[key] if key in self.entries else default
+
+    def keys(self):
+        return self.entries.keys()
+
+    def items(self):
+        for key in self.entries:
+            yield key, self[key]
+
+    def names(self):
+        return self.keys_by_name.keys()
+
+    def key_for(self, name):
+        return self.keys_by_name[name]
+
+    def by_name(self, name):
+        return self[self.keys_by_name[name]]
+
+    def info(self, key):
+        # (name, stored bytes, rendered characters)
+        name, offset, length, size = self.entries[key]
+        return name, length, size
+
+    def extract(self, key, fname):
+        with open(fname, 'w') as file:
+            file.write(self[key])
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ArchiveWriter:
+    # Adds variants to a new or existing archive. Entries are written as they
+    # are added and the index once on close(), so adding a whole batch costs
+    # one index write. The first text added becomes the base of a new archive
+    # unless base is given.
+    def __init__(self, path, base=None):
+        self.path = path
+        self.entries = []
+        self.keys = set()
+        self.names = set()
+        self.skipped = 0
+        self.base_lines = None
+
+        if os.path.exists(path):
+            self.file = open(path, 'r+b')
+            base_offset, base_length, index_offset, index_length = read_header(self.file.read(HEADER.size))
+            self.file.seek(index_offset)
+            for entry in read_index(self.file.read(index_length)):
+                self.append_entry(entry)
+
+            if base_length:
+                self.file.seek(base_offset)
+                self.set_base(decompress(self.file.read(base_length)).decode("utf-8"))
+            self.end = self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, 'w+b')
+            self.file.write(HEADER.pack(MAGIC, 0, 0, 0, 0))
+            self.end = HEADER.size
+            if base is not None:
+                self.write_base(base)
+
+    def append_entry(self, entry):
+        self.entries.append(entry)
+        self.keys.add(entry[0])
+        if entry[1] is not None:
+            self.names.add(entry[1])
+
+    def set_base(self, text):
+        self.base_lines = split_lines(text)
+        self.base_positions = line_positions(self.base_lines)
+        self.dictionary = text.encode("utf-8")[-DICTIONARY_SIZE:]
+
+    def write_base(self, text):
+        data = compress(text.encode("utf-8"))
+        self.file.seek(self.end)
+        self.file.write(data)
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, self.end, len(data), 0, 0))
+        self.end += len(data)
+        self.set_base(text)
+
+    def add(self, text, key=None, name=None):
+        # Returns the key, texts whose key is already in the archive are
+        # skipped
+        if key is None:
+            key = text_key(text)
+        if key in self.keys:
+            self.skipped += 1
+            return key
+        if name is not None and name in self.names:
+            raise ValueError("Name '{}' is already in the archive".format(name))
+
+        if self.base_lines is None:
+            self.write_base(text)
+
+        data = compress(encode_delta(self.base_lines, self.base_positions, text), self.dictionary)
+        self.file.seek(self.end)
+        self.file.write(data)
+        self.append_entry([key, name, self.end, len(data), len(text)])
+        self.end += len(data)
+        return key
+
+    def add_engine(self, engine, name=None):
+        text = engine.write_to_string()
+        return self.add(text, engine_key(engine, text), name)
+
+    def extend(self, engines, names=None):
+        for index, engine in enumerate(engines):
+            self.add_engine(engine, None if names is None else names[index])
+
+    def close(self):
+        # The new index goes after everything else and the header is only
+        # updated once it is on disk
+        index = compress(json.dumps({"entries": self.entries}).encode("utf-8"))
+        self.file.seek(self.end)
+        self.file.write(index)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        self.file.seek(0)
+        base_offset, base_length, _, _ = read_header(self.file.read(HEADER.size))
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, base_offset, base_length, self.end, len(index)))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def pack(path, specs, names=None, workers=None, chunksize=8):
+    # Renders specs (see batch.build_engine()) on a process pool and appends
+    # them to the archive in order, keyed by spec hash. Yields every
+    # BatchResult, failed variants are not added.
+    specs = list(specs)
+    with ArchiveWriter(path) as writer:
+        for result in batch.generate_batch(specs, workers, chunksize, ordered=True):
+            if result.ok:
+                engine = batch.build_engine(specs[result.index])
+                writer.add(result.output, engine_key(engine, result.output), None if names is None else names[result.index])
+            yield result
+
+def manifest_keys(directory):
+    # name -> spec hash of the files rendered by specs.py into directory
+    try:
+        with open(os.path.join(directory, "manifest.json")) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+def pack_files(path, fnames):
+    # Files rendered by specs.py are keyed by the spec hash in their
+    # manifest, others by a hash of their text
+    manifests = {}
+    with ArchiveWriter(path) as writer:
+        for fname in fnames:
+            directory = os.path.dirname(os.path.abspath(fname))
+            if directory not in manifests:
+                manifests[directory] = manifest_keys(directory)
+
+            name = os.path.splitext(os.path.basename(fname))[0]
+            with open(fname) as file:
+                text = file.read()
+            writer.add(text, manifests[directory].get(name), name)
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack generated .mr files into an indexed archive")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    pack_parser = commands.add_parser("pack", help="add files to an archive")
+    pack_parser.add_argument("archive")
+    pack_parser.add_argument("files", nargs="+")
+
+    list_parser = commands.add_parser("list", help="list the variants of an archive")
+    list_parser.add_argument("archive")
+
+    extract_parser = commands.add_parser("extract", help="write variants back out as .mr files")
+    extract_parser.add_argument("archive")
+    extract_parser.add_argument("names", nargs="*", help="all variants if none are given")
+    extract_parser.add_argument("-o", "--output-dir", default=".")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        pack_files(args.archive, args.files)
+        total = sum(os.path.getsize(fname) for fname in args.files)
+        print("{} bytes in, {} bytes archived".format(total, os.path.getsize(args.archive)))
+        return
+
+    with Archive(args.archive) as archive:
+        if args.command == "list":
+            for key in archive:
+                name, stored, size = archive.info(key)
+                print("{} {:>10} {:>10} {}".format(key, stored, size, name if name is not None else ""))
+            return
+
+        os.makedirs(args.output_dir, exist_ok=True)
+        keys = [archive.key_for(name) for name in args.names] if args.names else list(archive)
+        for key in keys:
+            name = archive.info(key)[0]
+            fname = os.path.join(args.output_dir, "{}.mr".format(name if name is not None else key))
+            archive.extract(key, fname)
+            print(fname)
+
+if __name__ == "__main__":
+    main()
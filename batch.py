@@ -0,0 +1,134 @@
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import os
+import traceback
+
+import engine_generator
+
+class BatchResult:
+    def __init__(self, index, output=None, error=None):
+        self.index = index
+        self.output = output
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+def build_engine(spec):
+    # A spec is either a ready made Engine or a picklable callable (a module
+    # level function or a functools.partial of one) that returns an Engine
+    if isinstance(spec, engine_generator.Engine):
+        return spec
+
+    return spec()
+
+def render_spec(index, spec, output_dir=None, filename="variant_{index}.mr"):
+    try:
+        engine = build_engine(spec)
+        engine.generate()
+
+        if output_dir is None:
+            return BatchResult(index, output=engine.write_to_string())
+
+        path = os.path.join(output_dir, filename.format(index=index, name=engine.engine_name))
+        engine.write_to_file(path)
+        return BatchResult(index, output=path)
+    except Exception:
+        return BatchResult(index, error=traceback.format_exc())
+
+def _render_chunk(chunk, output_dir, filename):
+    return [render_spec(index, spec, output_dir, filename) for index, spec in chunk]
+
+def _chunks(items, chunksize):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+def failed_chunk(chunk, error):
+    # on_error for map_chunks() over (index, ...) items
+    return [BatchResult(item[0], error=error) for item in chunk]
+
+def map_chunks(function, items, args=(), workers=None, chunksize=8, ordered=True, on_error=None):
+    # Calls function(chunk, *args) for chunks of items on a process pool and
+    # yields the items of the lists it returns. A chunk that cannot be sent
+    # to a worker or whose results cannot be returned (unpicklable items, a
+    # broken pool) raises, unless on_error(chunk, traceback text) gives the
+    # results to yield for it instead.
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    chunks = _chunks(items, chunksize)
+
+    # Only a few chunks are kept in flight so that huge (or endless) spec
+    # iterables are never materialized
+    max_pending = workers * 2
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        def submit(chunk):
+            # A broken pool refuses new work right away
+            try:
+                future = executor.submit(function, chunk, *args)
+            except Exception as e:
+                future = concurrent.futures.Future()
+                future.set_exception(e)
+            return future, chunk
+
+        def results(future, chunk):
+            try:
+                return future.result()
+            except Exception:
+                if on_error is None:
+                    raise
+                return on_error(chunk, traceback.format_exc())
+
+        if ordered:
+            pending = collections.deque(submit(chunk) for chunk in itertools.islice(chunks, max_pending))
+            while pending:
+                chunk_results = results(*pending.popleft())
+                for chunk in itertools.islice(chunks, 1):
+                    pending.append(submit(chunk))
+                yield from chunk_results
+        else:
+            pending = dict(submit(chunk) for chunk in itertools.islice(chunks, max_pending))
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for chunk in itertools.islice(chunks, len(done)):
+                    pending.update([submit(chunk)])
+                for future in done:
+                    yield from results(future, pending.pop(future))
+
+def generate_batch(specs, workers=None, chunksize=8, ordered=True, output_dir=None, filename="variant_{index}.mr"):
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    yield from map_chunks(_render_chunk, enumerate(specs), (output_dir, filename), workers, chunksize, ordered, failed_chunk)
+
+def main():
+    import engine
+
+    parser = argparse.ArgumentParser(description="Render engine variants in parallel")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=8)
+    parser.add_argument("--unordered", action="store_true")
+    parser.add_argument("-o", "--output-dir", default=".")
+    args = parser.parse_args()
+
+    specs = [engine.build_i4, engine.build_v24, engine.build_v69]
+    failures = 0
+    for result in generate_batch(specs, workers=args.workers, chunksize=args.chunksize, ordered=not args.unordered, output_dir=args.output_dir, filename="{name}.mr"):
+        if result.ok:
+            print(result.output)
+        else:
+            failures += 1
+            print("Variant {} failed:\n{}".format(result.index, result.error))
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
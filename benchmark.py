@@ -0,0 +1,172 @@
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+
+import engine
+import engine_generator
+
+PHASES = [
+    "index",
+    "rod_journals",
+    "camshaft_lobes",
+    "preamble",
+    "wires",
+    "head",
+    "camshaft",
+    "engine",
+    "vehicle_transmission",
+    "main_node"
+]
+
+BUNDLED = {
+    "i4": engine.build_i4,
+    "v24": engine.build_v24,
+    "v69": engine.build_v69
+}
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_BANK_COUNTS = [1, 2, 4, 12]
+
+def build_synthetic(n_cylinders, n_banks):
+    # Cylinders are dealt round robin onto banks spread evenly around the crank
+    banks = []
+    for index in range(n_banks):
+        bank_angle = -180 + 180 / n_banks + index * 360 / n_banks
+        banks.append(engine_generator.Bank(list(range(index, n_cylinders, n_banks)), bank_angle))
+
+    synthetic = engine_generator.Engine(banks, list(range(n_cylinders)))
+    synthetic.engine_name = "Synthetic {}x{}".format(n_banks, n_cylinders)
+    return synthetic
+
+def run_phase(subject, phase):
+    if phase == "index":
+        subject.build_index()
+        return 0
+    elif phase == "rod_journals":
+        subject.generate_rod_journals()
+        return 0
+    elif phase == "camshaft_lobes":
+        subject.generate_camshafts()
+        return 0
+
+    output_bytes = 0
+    for text in getattr(subject, "iter_" + phase)():
+        output_bytes += len(text)
+
+    return output_bytes
+
+def measure(build, repeat):
+    subject = build()
+    subject.seed = 0
+    cylinders = subject.cylinder_count()
+
+    results = {}
+    for phase in PHASES:
+        wall_time = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output_bytes = run_phase(subject, phase)
+            elapsed = time.perf_counter() - start
+            wall_time = elapsed if wall_time is None else min(wall_time, elapsed)
+
+        # Separate pass as tracing allocations distorts the timings
+        tracemalloc.start()
+        run_phase(subject, phase)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results[phase] = {
+            "wall_time": wall_time,
+            "peak_memory": peak_memory,
+            "output_bytes": output_bytes,
+            "bytes_per_second": output_bytes / wall_time if wall_time > 0 else 0.0,
+            "cylinders_per_second": cylinders / wall_time if wall_time > 0 else 0.0
+        }
+
+    total_time = sum(result["wall_time"] for result in results.values())
+    total_bytes = sum(result["output_bytes"] for result in results.values())
+    results["total"] = {
+        "wall_time": total_time,
+        "peak_memory": max(result["peak_memory"] for result in results.values()),
+        "output_bytes": total_bytes,
+        "bytes_per_second": total_bytes / total_time if total_time > 0 else 0.0,
+        "cylinders_per_second": cylinders / total_time if total_time > 0 else 0.0
+    }
+
+    return {
+        "cylinders": cylinders,
+        "banks": len(subject.banks),
+        "phases": results
+    }
+
+def configurations(sizes, bank_counts, bundled=True):
+    if bundled:
+        for name, build in BUNDLED.items():
+            yield name, build
+
+    for n_cylinders in sizes:
+        for n_banks in bank_counts:
+            yield "synthetic_{}x{}".format(n_banks, n_cylinders), lambda n=n_cylinders, b=n_banks: build_synthetic(n, b)
+
+def run(sizes=DEFAULT_SIZES, bank_counts=DEFAULT_BANK_COUNTS, repeat=3, bundled=True, log=print):
+    report = {
+        "generator_version": engine_generator.GENERATOR_VERSION,
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+        "repeat": repeat,
+        "configurations": {}
+    }
+
+    for name, build in configurations(sizes, bank_counts, bundled):
+        result = measure(build, repeat)
+        report["configurations"][name] = result
+        if log is not None:
+            total = result["phases"]["total"]
+            log("{:<24} {:>8} cylinders {:>10.4f} s {:>12} B {:>14.0f} B/s {:>12.0f} cyl/s {:>12} B peak".format(
+                name, result["cylinders"], total["wall_time"], total["output_bytes"], total["bytes_per_second"], total["cylinders_per_second"], total["peak_memory"]))
+
+    return report
+
+def compare(baseline, current, log=print):
+    # Ratio of current to baseline wall time for every phase present in both
+    # reports, above 1.0 is slower
+    ratios = {}
+    for name, result in current["configurations"].items():
+        base = baseline["configurations"].get(name)
+        if base is None:
+            continue
+
+        for phase, timings in result["phases"].items():
+            base_timings = base["phases"].get(phase)
+            if base_timings is None or base_timings["wall_time"] <= 0:
+                continue
+
+            ratio = timings["wall_time"] / base_timings["wall_time"]
+            ratios["{}.{}".format(name, phase)] = ratio
+            if log is not None:
+                log("{:<48} {:>6.2f}x".format("{}.{}".format(name, phase), ratio))
+
+    return ratios
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark engine generation and rendering")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--banks", type=int, nargs="+", default=DEFAULT_BANK_COUNTS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-bundled", action="store_true")
+    parser.add_argument("-o", "--output", default="benchmark.json")
+    parser.add_argument("--compare", metavar="BASELINE")
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.banks, args.repeat, not args.no_bundled)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=4)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as file:
+            compare(json.load(file), report)
+
+if __name__ == "__main__":
+    main()
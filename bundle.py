@@ -0,0 +1,78 @@
+import copy
+import hashlib
+
+PLACEHOLDER = "__bundle_node__"
+
+# Shared node kinds: prefix of the generated node names, how to set the node
+# name on an engine and which writer renders the node
+SHARED_NODES = [
+    ("wires", "bundle_wires", lambda engine, name: setattr(engine, "wires_node_name", name), "iter_wires"),
+    ("head", "bundle_head", lambda engine, name: setattr(engine, "cylinder_head_node_name", name), "iter_head"),
+    ("camshaft", "bundle_camshaft", lambda engine, name: setattr(engine, "camshaft_node_name", name), "iter_camshaft"),
+    ("vehicle", "bundle_vehicle", lambda engine, name: setattr(engine.vehicle, "node_name", name), "iter_vehicle"),
+    ("transmission", "bundle_transmission", lambda engine, name: setattr(engine.transmission, "node_name", name), "iter_transmission"),
+    ("engine", "bundle_engine", lambda engine, name: setattr(engine, "node_name", name), "iter_engine")
+]
+
+class BundleStats:
+    def __init__(self):
+        self.variants = 0
+        self.shared_nodes = {kind: 0 for kind, _, _, _ in SHARED_NODES}
+        self.reused_nodes = {kind: 0 for kind, _, _, _ in SHARED_NODES}
+
+def iter_variant_node(name, engine):
+    yield """public node {} {{
+    run(
+        engine: {}(),
+        vehicle: {}(),
+        transmission: {}()
+    )
+}}\n\n""".format(name, engine.node_name, engine.vehicle.node_name, engine.transmission.node_name)
+
+def iter_bundle(engines, names=None, stats=None):
+    # One library for many variants. Wires, cylinder head, camshaft, vehicle,
+    # transmission and engine nodes are keyed by their rendered text and
+    # emitted only the first time they occur, every variant is a thin public
+    # node named after it that runs its engine. The engines passed in are not
+    # modified.
+    if stats is None:
+        stats = BundleStats()
+
+    seen = {kind: {} for kind, _, _, _ in SHARED_NODES}
+    preamble = False
+
+    for index, engine in enumerate(engines):
+        variant = copy.deepcopy(engine)
+        name = names[index] if names is not None else "variant_{}".format(index)
+
+        if not preamble:
+            yield from variant.iter_preamble()
+            preamble = True
+
+        # The engine node goes last as it refers to all the other nodes
+        for kind, prefix, set_name, writer in SHARED_NODES:
+            set_name(variant, PLACEHOLDER)
+            text = "".join(getattr(variant, writer)())
+            key = hashlib.sha1(text.encode("utf-8")).digest()
+
+            node_name = seen[kind].get(key)
+            if node_name is None:
+                node_name = "{}_{}".format(prefix, len(seen[kind]))
+                seen[kind][key] = node_name
+                stats.shared_nodes[kind] += 1
+                yield text.replace(PLACEHOLDER, node_name)
+            else:
+                stats.reused_nodes[kind] += 1
+
+            set_name(variant, node_name)
+
+        yield from iter_variant_node(name, variant)
+        stats.variants += 1
+
+def write_bundle(engines, fname, names=None, stats=None):
+    with open(fname, 'w') as file:
+        for text in iter_bundle(engines, names, stats):
+            file.write(text)
+
+def bundle_to_string(engines, names=None, stats=None):
+    return "".join(iter_bundle(engines, names, stats))
@@ -0,0 +1,149 @@
+import math
+
+import numpy as np
+
+import simulation_cost
+
+MIN_LOBE_STEPS = 8
+
+# Lift (thou) at which lobe durations are measured
+DURATION_LIFT = 50
+REFERENCE_SAMPLES = 4096
+
+class CurveReport:
+    def __init__(self):
+        self.before = {}
+        self.after = {}
+        self.max_error = {}
+        self.estimated_speedup = 1.0
+
+    def to_dict(self):
+        return {
+            "before": self.before,
+            "after": self.after,
+            "max_error": self.max_error,
+            "estimated_speedup": self.estimated_speedup
+        }
+
+def lobe_half_width(duration, gamma, lift):
+    # Half width (deg) at which a lift * ((1 + cos(pi * x / h)) / 2) ^ gamma
+    # profile closes, chosen so that the lift is 50 thou at +/- duration / 2
+    if lift <= DURATION_LIFT:
+        raise ValueError("Lobe lift of {} thou does not exceed the {} thou the duration is measured at".format(lift, DURATION_LIFT))
+
+    ratio = (DURATION_LIFT / lift) ** (1 / gamma)
+    return math.pi * duration / (2 * math.acos(2 * ratio - 1))
+
+def lobe_profile(x, duration, gamma, lift):
+    h = lobe_half_width(duration, gamma, lift)
+    x = np.clip(np.abs(x), 0, h)
+    return lift * ((1 + np.cos(np.pi * x / h)) / 2) ** gamma
+
+def lobe_error(steps, duration, gamma, lift):
+    # Largest lift error (thou) of a lobe sampled with the given number of
+    # steps and linearly interpolated in between
+    h = lobe_half_width(duration, gamma, lift)
+    x = np.linspace(-h, h, REFERENCE_SAMPLES)
+    samples = np.linspace(-h, h, steps)
+    approximation = np.interp(x, samples, lobe_profile(samples, duration, gamma, lift))
+    return float(np.max(np.abs(approximation - lobe_profile(x, duration, gamma, lift))))
+
+def reduce_lobe_steps(steps, duration, gamma, lift, tolerance):
+    # Smallest step count within tolerance, the error shrinks monotonically
+    # with the step count so this is a plain bisection
+    if lobe_error(steps, duration, gamma, lift) > tolerance:
+        return steps
+
+    low, high = MIN_LOBE_STEPS, steps
+    while low < high:
+        middle = (low + high) // 2
+        if lobe_error(middle, duration, gamma, lift) <= tolerance:
+            high = middle
+        else:
+            low = middle + 1
+
+    return high
+
+def decimate(y, tolerance):
+    # Largest stride that keeps both end points and still reproduces every
+    # original sample within tolerance when interpolating linearly. Samples
+    # stay evenly spaced, as engine-sim uses the spacing as filter radius.
+    y = np.asarray(y, dtype=float)
+    x = np.arange(len(y))
+
+    for stride in range(len(y) - 1, 1, -1):
+        if (len(y) - 1) % stride != 0:
+            continue
+
+        kept = x[::stride]
+        error = float(np.max(np.abs(np.interp(x, kept, y[kept]) - y)))
+        if error <= tolerance:
+            return stride, error
+
+    return 1, 0.0
+
+def optimize(engine, lift_tolerance=1.0, flow_tolerance=1.0, timing_tolerance=0.5, model=None, apply=True):
+    # Reduces the lobe step counts, flow tables and timing curve of an engine
+    # to the smallest versions within the given tolerances (thou, flow units
+    # and degrees of advance) and reports the estimated simulator speedup.
+    # Errors are measured against the original samples (or, for the lobes, a
+    # densely sampled harmonic profile) under linear interpolation.
+    if model is None:
+        model = simulation_cost.CostModel()
+
+    report = CurveReport()
+    cost_before = model.estimate(engine)
+    changes = {}
+
+    for kind in ("intake", "exhaust"):
+        steps = getattr(engine, kind + "_lobe_steps")
+        duration = getattr(engine, kind + "_lobe_duration")
+        gamma = getattr(engine, kind + "_lobe_gamma")
+        lift = getattr(engine, kind + "_lobe_lift")
+
+        # The profile is undefined for lobes that never reach the duration
+        # lift, their step count is left alone
+        if lift > DURATION_LIFT:
+            reduced = reduce_lobe_steps(steps, duration, gamma, lift, lift_tolerance)
+            error = lobe_error(reduced, duration, gamma, lift)
+        else:
+            reduced, error = steps, 0.0
+        report.before[kind + "_lobe_steps"] = steps
+        report.after[kind + "_lobe_steps"] = reduced
+        report.max_error[kind + "_lobe"] = error
+        changes[kind + "_lobe_steps"] = reduced
+
+        flow = getattr(engine, kind + "_flow")
+        stride, error = decimate(flow, flow_tolerance) if len(flow) > 2 else (1, 0.0)
+        report.before[kind + "_flow_samples"] = len(flow)
+        report.after[kind + "_flow_samples"] = len(flow[::stride])
+        report.max_error[kind + "_flow"] = error
+        if stride > 1:
+            changes[kind + "_flow"] = flow[::stride]
+            changes[kind + "_flow_step"] = getattr(engine, kind + "_flow_step") * stride
+
+    # Only evenly spaced timing curves can be decimated, see decimate()
+    rpm = [point[0] for point in engine.timing_curve]
+    advance = [point[1] for point in engine.timing_curve]
+    uniform = len(rpm) > 2 and all(abs((b - a) - engine.timing_curve_step) < 1e-9 for a, b in zip(rpm, rpm[1:]))
+    stride, error = decimate(advance, timing_tolerance) if uniform else (1, 0.0)
+    report.before["timing_samples"] = len(rpm)
+    report.after["timing_samples"] = len(engine.timing_curve[::stride])
+    report.max_error["timing"] = error
+    if stride > 1:
+        changes["timing_curve"] = [list(point) for point in engine.timing_curve[::stride]]
+        changes["timing_curve_step"] = engine.timing_curve_step * stride
+
+    parameters = simulation_cost.engine_parameters(engine)
+    parameters["intake_lobe_steps"] = changes["intake_lobe_steps"]
+    parameters["exhaust_lobe_steps"] = changes["exhaust_lobe_steps"]
+    parameters["intake_flow_samples"] = report.after["intake_flow_samples"]
+    parameters["exhaust_flow_samples"] = report.after["exhaust_flow_samples"]
+    cost_after = model.estimate_parameters(parameters)
+    report.estimated_speedup = cost_before / cost_after if cost_after > 0 else 1.0
+
+    if apply:
+        for name, value in changes.items():
+            setattr(engine, name, value)
+
+    return report
@@ -0,0 +1,57 @@
+import operator
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Counter based random numbers: every value is a splitmix64 hash of (seed,
+# stream, cylinder), so a cylinder gets the same values whatever bank it is
+# in, however many cylinders the engine has and in whichever order they are
+# drawn. NumPy hashes a whole bank at once, the pure Python version gives
+# the same bits and is used when NumPy is missing.
+
+MASK = (1 << 64) - 1
+GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+
+STREAMS = {
+    "sound_attenuation": 1,
+    "piston_blowby": 2,
+    "primary_length": 3
+}
+
+def mix(z):
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK
+    return z ^ (z >> 31)
+
+def stream_key(seed, stream):
+    # NumPy integer seeds overflow when masked, they are hashed as ints
+    return mix((mix(operator.index(seed) & MASK) + STREAMS[stream] * GOLDEN_GAMMA) & MASK)
+
+def mix_array(z):
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def uniform(seed, cylinders, ranges):
+    # {stream: [value in [low, high) for every cylinder]} for ranges given as
+    # {stream: (low, high)}
+    if np is None:
+        values = {}
+        for stream, (low, high) in ranges.items():
+            key = stream_key(seed, stream)
+            values[stream] = [low + (high - low) * ((mix((key + cylinder * GOLDEN_GAMMA) & MASK) >> 11) * 2.0 ** -53) for cylinder in cylinders]
+        return values
+
+    # One draw for all streams, uint64 arithmetic wraps around like the
+    # masked Python version
+    streams = list(ranges)
+    keys = np.array([stream_key(seed, stream) for stream in streams], dtype=np.uint64)
+    low = np.array([ranges[stream][0] for stream in streams], dtype=float)
+    high = np.array([ranges[stream][1] for stream in streams], dtype=float)
+    counters = np.asarray(cylinders, dtype=np.uint64) * np.uint64(GOLDEN_GAMMA)
+    draws = (mix_array(keys[:, None] + counters[None, :]) >> np.uint64(11)) * 2.0 ** -53
+    values = low[:, None] + (high - low)[:, None] * draws
+
+    return {stream: row.tolist() for stream, row in zip(streams, values)}
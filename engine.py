@@ -1,7 +1,6 @@
-
 import engine_generator
 
-def generate_i4():
+def build_i4():
     cylinders0 = []
     cylinders = [0,2,3,1]
 
@@ -14,11 +13,15 @@ def generate_i4():
     engine.starter_torque = 400
     engine.chamber_volume = 70
 
+    return engine
+
+def generate_i4():
+    engine = build_i4()
     engine.generate()
     engine.write_to_file("i4.mr")
 
 
-def generate_v24():
+def build_v24():
     cylinders0 = []
     cylinders1 = []
     cylinders = []
@@ -35,10 +38,14 @@ def generate_v24():
     engine.starter_torque = 400
     engine.crank_mass = 200
 
+    return engine
+
+def generate_v24():
+    engine = build_v24()
     engine.generate()
     engine.write_to_file("test.mr")
 
-def generate_v69():
+def build_v69():
     cylinders0 = []
     cylinders1 = []
     cylinders = []
@@ -67,6 +74,10 @@ def generate_v69():
     engine.fluid_simulation_steps = 4
     engine.idle_throttle_plate_position = 0.9
 
+    return engine
+
+def generate_v69():
+    engine = build_v69()
     engine.generate()
     engine.write_to_file("v69_engine.mr")
 
@@ -1,7 +1,85 @@
+import concurrent.futures
+import copy
+import hashlib
+import itertools
+import json
+import operator
+import os
 import random
-import io
+from array import array
+
+import cylinder_random
+import files
+import instrumentation
+import simulation_cost
+import templates
+import validation
+
+GENERATOR_VERSION = "3"
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Parallel rendering (see Engine.iter_document_parallel()) is only used for
+# engines with at least PARALLEL_THRESHOLD cylinders. Repeated segments are
+# split into about TASKS_PER_WORKER slices per worker of at least
+# MIN_TASK_ROWS rows each.
+PARALLEL_THRESHOLD = 20000
+TASKS_PER_WORKER = 4
+MIN_TASK_ROWS = 4096
+
+# Templates of the rows repeated for every wire, flow sample, lobe, journal,
+# cylinder, timing sample, ignition wire and gear, compiled once per process
+# and rendered in bulk from columns of values
+WIRE = templates.compile_template("    output wire{}: ignition_wire();\n")
+COMPACT_WIRE = templates.compile_template("output wire{}:ignition_wire();\n")
+FLOW_SAMPLE = templates.compile_template("\n    .add_flow_sample({} * lift_scale, {} * flow_attenuation)")
+EXHAUST_LOBE = templates.compile_template("        .add_lobe(rot360 - exhaust_lobe_center + {} * units.deg)\n")
+INTAKE_LOBE = templates.compile_template("        .add_lobe(rot360 + exhaust_lobe_center + {} * units.deg)\n")
+COMPACT_EXHAUST_LOBE = templates.compile_template(".add_lobe(rot360-exhaust_lobe_center+{}*deg)\n")
+COMPACT_INTAKE_LOBE = templates.compile_template(".add_lobe(rot360+exhaust_lobe_center+{}*deg)\n")
+ROD_JOURNAL = templates.compile_template("    rod_journal rj{}(angle: {} * units.deg)\n")
+COMPACT_ROD_JOURNAL = templates.compile_template("rod_journal rj{}(angle:{}*deg)\n")
+ADD_ROD_JOURNAL = templates.compile_template("        .add_rod_journal(rj{})\n")
+COMPACT_ADD_ROD_JOURNAL = templates.compile_template(".add_rod_journal(rj{})\n")
+CYLINDER = templates.compile_template("""        .add_cylinder(
+            piston: piston(piston_params, blowby: k_28inH2O({})),
+            connecting_rod: connecting_rod(cr_params),
+            rod_journal: rj{},
+            intake: intake,
+            exhaust_system: exhaust{},
+            ignition_wire: wires.wire{},
+            sound_attenuation: {},
+            primary_length: {} * spacing * 0.5 * units.cm{}
+        )\n""")
+COMPACT_CYLINDER = templates.compile_template(".add_cylinder(piston:piston(piston_params,blowby:{}),connecting_rod:connecting_rod(cr_params),rod_journal:rj{},intake:intake,exhaust_system:exhaust{},ignition_wire:wires.wire{},sound_attenuation:{},primary_length:{}*primary_step{})\n")
+TIMING_SAMPLE = templates.compile_template("\n        .add_sample({} * units.rpm, {} * units.deg)")
+CONNECT_WIRE = templates.compile_template("            .connect_wire(wires.wire{}, {} * units.deg)\n")
+COMPACT_CONNECT_WIRE = templates.compile_template(".connect_wire(wires.wire{},{}*deg)\n")
+GEAR = templates.compile_template("\n    .add_gear({})")
+
+DEFAULT_SOUND_ATTENUATION_RANGE = [0.5, 1.0]
+
+_worker_engine = None
+
+def _start_worker(engine):
+    global _worker_engine
+    _worker_engine = engine
+
+def _render_rows(name, key, start, stop):
+    return "".join(getattr(_worker_engine, "iter_{}_rows".format(name))(key, start, stop))
+
+def set_parameters(target, parameters, kind):
+    for name, value in parameters.items():
+        if name.startswith("_") or name not in target.__slots__:
+            raise ValueError("Unknown {} parameter '{}'".format(kind, name))
+        setattr(target, name, value)
 
 class Fuel:
+    __slots__ = (
+        "molecular_mass", "energy_density", "density", "molecular_afr",
+        "max_burning_efficiency", "burning_efficiency_randomness",
+        "low_efficiency_attenuation", "max_turbulence_effect",
+        "max_dilution_effect")
+
     def __init__(self):
         # Gasoline
         self.molecular_mass = 100
@@ -25,31 +103,115 @@ class Fuel:
             max_turbulence_effect: {},
             max_dilution_effect: {}""".format(self.molecular_mass, self.energy_density, self.density, self.molecular_afr, self.max_burning_efficiency, self.burning_efficiency_randomness, self.low_efficiency_attenuation, self.max_turbulence_effect, self.max_dilution_effect)
 
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, parameters):
+        fuel = cls()
+        set_parameters(fuel, parameters, "fuel")
+        return fuel
+
 class Camshaft:
+    __slots__ = ("lobes",)
+
     def __init__(self):
-        self.lobes = []
+        self.lobes = array('d')
 
 class Bank:
+    __slots__ = ("_cylinders", "_cylinder_index", "_bank_angle", "revision", "camshaft", "flip")
+
     def __init__(self, cylinder_numbers, bank_angle):
+        self.revision = 0
         self.cylinders = cylinder_numbers
         self.bank_angle = bank_angle
 
         self.camshaft = Camshaft()
-        self.camshaft.lobes = [0] * len(self.cylinders)
+        self.camshaft.lobes = array('d', [0.0]) * len(self.cylinders)
 
         self.flip = False
 
+    @property
+    def cylinders(self):
+        return self._cylinders
+
+    @cylinders.setter
+    def cylinders(self, cylinders):
+        self._cylinders = tuple(cylinders)
+        self._cylinder_index = None
+        self.revision += 1
+
+    @property
+    def bank_angle(self):
+        return self._bank_angle
+
+    @bank_angle.setter
+    def bank_angle(self, bank_angle):
+        self._bank_angle = bank_angle
+        self.revision += 1
+
+    def build_index(self):
+        self._cylinder_index = {}
+        for index, cylinder in enumerate(self._cylinders):
+            self._cylinder_index.setdefault(cylinder, index)
+
     def get_cylinder_index(self, cylinder):
-        return self.cylinders.index(cylinder)
+        if self._cylinder_index is None:
+            self.build_index()
+
+        index = self._cylinder_index.get(cylinder)
+        if index is None:
+            raise ValueError("{} is not in bank".format(cylinder))
+
+        return index
+
+    def to_dict(self):
+        return {
+            "cylinders": list(self.cylinders),
+            "bank_angle": self.bank_angle,
+            "flip": self.flip
+        }
+
+    @classmethod
+    def from_dict(cls, parameters):
+        parameters = dict(parameters)
+        try:
+            bank = cls(parameters.pop("cylinders"), parameters.pop("bank_angle"))
+        except KeyError as e:
+            raise ValueError("Bank parameter {} is missing".format(e))
+
+        bank.flip = parameters.pop("flip", False)
+        if parameters:
+            raise ValueError("Unknown bank parameter '{}'".format(next(iter(parameters))))
+
+        return bank
 
 class Transmission:
+    __slots__ = ("gears", "node_name", "max_clutch_torque")
+
     def __init__(self, gears):
         self.gears = gears
         self.node_name = "generated_transmission"
 
         self.max_clutch_torque = 1000
 
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, parameters):
+        if "gears" not in parameters:
+            raise ValueError("Transmission parameter 'gears' is missing")
+
+        transmission = cls(parameters["gears"])
+        set_parameters(transmission, parameters, "transmission")
+        return transmission
+
 class Vehicle:
+    __slots__ = (
+        "node_name", "mass", "drag_coefficient", "cross_sectional_area",
+        "diff_ratio", "tire_radius", "rolling_resistance")
+
     def __init__(self):
         self.node_name = "generated_vehicle"
 
@@ -61,7 +223,79 @@ class Vehicle:
         self.tire_radius = 9
         self.rolling_resistance = 200
 
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, parameters):
+        vehicle = cls()
+        set_parameters(vehicle, parameters, "vehicle")
+        return vehicle
+
 class Engine:
+    # Parameters read by each section of the document, in document order. A
+    # section is only re-rendered by write_to_string() when one of these
+    # changes.
+    SECTION_DEPENDENCIES = {
+        "preamble": (),
+        "wires": ("wires_node_name", "banks", "compact"),
+        "head": (
+            "cylinder_head_node_name", "chamber_volume",
+            "intake_runner_volume", "intake_runner_cross_section",
+            "exhaust_runner_volume", "exhaust_runner_cross_section",
+            "intake_flow", "exhaust_flow", "intake_flow_step",
+            "exhaust_flow_step"),
+        "camshaft": (
+            "camshaft_node_name", "lobe_separation", "camshaft_base_radius",
+            "banks", "compact", "compact_precision"),
+        "engine": (
+            "node_name", "wires_node_name", "engine_name", "starter_torque", "starter_speed",
+            "redline", "throttle_gamma", "fuel", "hf_gain", "noise", "jitter",
+            "simulation_frequency", "engine_sim_version",
+            "fluid_simulation_steps", "max_sle_solver_steps",
+            "stroke", "bore", "rod_length", "rod_mass", "compression_height",
+            "crank_mass", "flywheel_mass", "flywheel_radius", "piston_mass",
+            "piston_blowby", "piston_blowby_variation", "sound_attenuation_range",
+            "primary_length_variation", "plenum_volume", "plenum_cross_section_area",
+            "intake_flow_rate", "runner_flow_rate", "runner_length",
+            "idle_flow_rate", "idle_throttle_plate_position", "exhaust_length",
+            "cylinder_head_node_name", "camshaft_node_name",
+            "intake_lobe_center", "exhaust_lobe_center",
+            "intake_lobe_lift", "intake_lobe_duration", "intake_lobe_gamma",
+            "intake_lobe_steps", "exhaust_lobe_lift", "exhaust_lobe_duration",
+            "exhaust_lobe_gamma", "exhaust_lobe_steps", "timing_curve",
+            "timing_curve_step",
+            "rev_limit", "limiter_duration", "banks", "rod_journals",
+            "firing_order", "seed", "compact", "compact_precision"),
+        "vehicle_transmission": ("vehicle", "transmission"),
+        "main_node": ("node_name", "vehicle", "transmission")
+    }
+
+    __slots__ = (
+        "banks", "fuel", "starter_torque", "starter_speed", "redline",
+        "throttle_gamma", "node_name", "wires_node_name", "engine_name", "hf_gain", "noise",
+        "jitter", "stroke", "bore", "rod_length", "rod_mass",
+        "compression_height", "crank_mass", "flywheel_mass", "flywheel_radius",
+        "piston_mass", "piston_blowby", "piston_blowby_variation",
+        "sound_attenuation_range", "primary_length_variation", "plenum_volume",
+        "plenum_cross_section_area", "intake_flow_rate", "runner_flow_rate",
+        "runner_length", "idle_flow_rate", "exhaust_length",
+        "camshaft_node_name", "lobe_separation", "camshaft_base_radius",
+        "intake_lobe_center", "exhaust_lobe_center", "intake_lobe_lift",
+        "intake_lobe_duration", "intake_lobe_gamma", "intake_lobe_steps",
+        "exhaust_lobe_lift", "exhaust_lobe_duration", "exhaust_lobe_gamma",
+        "exhaust_lobe_steps", "cylinder_head_node_name", "chamber_volume",
+        "intake_runner_volume", "intake_runner_cross_section",
+        "exhaust_runner_volume", "exhaust_runner_cross_section", "intake_flow",
+        "exhaust_flow", "intake_flow_step", "exhaust_flow_step",
+        "_rod_journals", "_firing_order", "simulation_frequency",
+        "max_sle_solver_steps", "fluid_simulation_steps",
+        "idle_throttle_plate_position", "engine_sim_version", "timing_curve",
+        "timing_curve_step", "rev_limit", "limiter_duration", "vehicle",
+        "transmission", "seed", "compact", "compact_precision",
+        "_cylinder_banks", "_firing_positions", "_index_key", "_geometry_key",
+        "_checked_key", "_sections", "_stats", "_pool")
+
     def __init__(self, banks, firing_order):
         self.banks = banks
         self.fuel = Fuel()
@@ -71,6 +305,7 @@ class Engine:
         self.throttle_gamma = 2.0
 
         self.node_name = "generated_engine"
+        self.wires_node_name = "wires"
         self.engine_name = "Test Engine"
 
         self.hf_gain = 0.01
@@ -88,6 +323,13 @@ class Engine:
         self.piston_mass = 50
         self.piston_blowby = 0.0
 
+        # Per-cylinder variation: sound attenuation is drawn from the range,
+        # blowby varies by up to +/- the given fraction and the primary length
+        # grows by up to the given length (cm)
+        self.sound_attenuation_range = list(DEFAULT_SOUND_ATTENUATION_RANGE)
+        self.piston_blowby_variation = 0.0
+        self.primary_length_variation = 0.0
+
         self.plenum_volume = 1.325
         self.plenum_cross_section_area = 20.0
         self.intake_flow_rate = 3000
@@ -123,8 +365,14 @@ class Engine:
         self.intake_flow = [0,58,103,156,214,249,268,280,280,281]
         self.exhaust_flow = [0,37,72,113,160,196,222,235,245,246]
 
-        self.rod_journals = None
+        # Lift between flow samples (thou) and rpm between timing samples,
+        # also used as the filter radius of the functions
+        self.intake_flow_step = 50
+        self.exhaust_flow_step = 50
+
         self.firing_order = firing_order
+        self._rod_journals = None
+        self.invalidate_geometry()
 
         self.simulation_frequency = 10000
         self.max_sle_solver_steps = 128
@@ -145,6 +393,7 @@ class Engine:
             [8000,40],
             [9000,40],
         ]
+        self.timing_curve_step = 1000
         
         self.rev_limit = self.redline + 1000
         self.limiter_duration = 0.1
@@ -152,27 +401,175 @@ class Engine:
         self.vehicle = Vehicle()
         self.transmission = Transmission([2.8, 2.29, 1.93, 1.583, 1.375, 1.19])
 
-    def get_cylinder_bank(self, cylinder):
+        # Seed for the per-cylinder randomization, None draws from the global
+        # random state and gives a different output on every render
+        self.seed = None
+
+        # Compact output shares per-cylinder values through labels, writes
+        # angles and attenuations with compact_precision decimals and drops
+        # whitespace from the lines repeated for every cylinder and lobe
+        self.compact = False
+        self.compact_precision = 4
+
+        self._sections = {}
+
+        # Render statistics, None unless instrument() is called
+        self._stats = None
+
+        # (executor, rows per task) during a parallel render
+        self._pool = None
+
+    def to_dict(self):
+        # Every input parameter of the engine, derived values such as the rod
+        # journals and the camshaft lobes are left out
+        parameters = {}
+        for key in self.__slots__:
+            if key.startswith("_"):
+                continue
+            parameters[key] = getattr(self, key)
+
+        # A NumPy integer seed as int, so that it can be hashed and saved
+        if self.seed is not None:
+            parameters["seed"] = operator.index(self.seed)
+
+        parameters["fuel"] = self.fuel.to_dict()
+        parameters["vehicle"] = self.vehicle.to_dict()
+        parameters["transmission"] = self.transmission.to_dict()
+        parameters["banks"] = [bank.to_dict() for bank in self.banks]
+        parameters["firing_order"] = list(self.firing_order)
+
+        return parameters
+
+    @classmethod
+    def from_dict(cls, parameters):
+        # Inverse of to_dict(). Only banks and firing_order are required, any
+        # other parameter keeps its default when left out and the fuel,
+        # vehicle and transmission may be given in part.
+        parameters = dict(parameters)
+        try:
+            banks = [Bank.from_dict(bank) for bank in parameters.pop("banks")]
+            engine = cls(banks, parameters.pop("firing_order"))
+        except KeyError as e:
+            raise ValueError("Engine parameter {} is missing".format(e))
+
+        set_parameters(engine.fuel, parameters.pop("fuel", {}), "fuel")
+        set_parameters(engine.vehicle, parameters.pop("vehicle", {}), "vehicle")
+        set_parameters(engine.transmission, parameters.pop("transmission", {}), "transmission")
+        set_parameters(engine, parameters, "engine")
+
+        return engine
+
+    def spec_hash(self):
+        spec = {"generator_version": GENERATOR_VERSION, "engine": self.to_dict()}
+        return hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @property
+    def firing_order(self):
+        return self._firing_order
+
+    @firing_order.setter
+    def firing_order(self, firing_order):
+        # Stored as a tuple so that every change goes through this setter
+        self._firing_order = tuple(firing_order)
+
+    @property
+    def rod_journals(self):
+        self.refresh_geometry()
+        return self._rod_journals
+
+    def lobes(self, bank):
+        # Lobe table of a bank, given as index or Bank. bank.camshaft.lobes
+        # itself only holds the table from the last refresh.
+        self.refresh_geometry()
+        if not isinstance(bank, Bank):
+            bank = self.banks[bank]
+        return bank.camshaft.lobes
+
+    def geometry_key(self):
+        # Everything the derived geometry depends on. The firing order and
+        # bank cylinders are immutable and banks bump their revision on every
+        # change, so comparing keys costs O(banks) and not O(cylinders).
+        return (self._firing_order,) + tuple((bank, bank.revision) for bank in self.banks)
+
+    def invalidate_geometry(self):
+        self._index_key = None
+        self._geometry_key = None
+        self._checked_key = None
+
+    def refresh_index(self):
+        if self._index_key != self.geometry_key():
+            self.build_index()
+
+    def refresh_geometry(self):
+        key = self.geometry_key()
+        if self._geometry_key != key:
+            self.check()
+            if self._stats is None:
+                self.generate_rod_journals()
+                self.generate_camshafts()
+            else:
+                self._stats.measure("generate_rod_journals", self.generate_rod_journals)
+                self._stats.measure("generate_camshafts", self.generate_camshafts)
+            self._geometry_key = key
+
+    def check(self):
+        # Raises validation.ValidationError if the engine cannot be rendered,
+        # see validation.py. Called before any geometry or output is
+        # generated. The O(cylinders) bank and firing order checks are only
+        # repeated after one of them changes.
+        problems = validation.errors(validation.check_settings(self))
+        key = self.geometry_key()
+        if self._checked_key != key:
+            problems = validation.errors(validation.check_geometry(self)) + problems
+
+        if problems:
+            raise validation.ValidationError(problems)
+
+        self._checked_key = key
+
+    def build_index(self):
+        # Lookup tables used by the generation passes
+        self._cylinder_banks = {}
         for bank in self.banks:
-            if cylinder in bank.cylinders:
-                return bank
-            
-        return None
+            bank.build_index()
+            for cylinder in bank.cylinders:
+                self._cylinder_banks.setdefault(cylinder, bank)
+
+        self._firing_positions = {}
+        for position, cylinder in enumerate(self._firing_order):
+            self._firing_positions.setdefault(cylinder, position)
+
+        self._index_key = self.geometry_key()
+
+    def get_cylinder_bank(self, cylinder):
+        self.refresh_index()
+        return self._cylinder_banks.get(cylinder)
+
+    def get_firing_order_position(self, cylinder):
+        self.refresh_index()
+
+        position = self._firing_positions.get(cylinder)
+        if position is None:
+            raise ValueError("{} is not in firing order".format(cylinder))
+
+        return position
     
     def tdc(self):
         return 90 + self.banks[0].bank_angle
 
     def generate_rod_journals(self):
+        self.refresh_index()
+
         n_cylinders = len(self.firing_order)
         gap = 720 / n_cylinders
         tdc = self.tdc()
         current_crank_angle = 0
 
-        self.rod_journals = [0] * n_cylinders
+        self._rod_journals = array('d', [0.0]) * n_cylinders
         for cylinder in self.firing_order:
-            bank = self.get_cylinder_bank(cylinder)
+            bank = self._cylinder_banks.get(cylinder)
             bank_angle = bank.bank_angle + 90
-            self.rod_journals[cylinder] = (-current_crank_angle) + bank_angle - tdc
+            self._rod_journals[cylinder] = (-current_crank_angle) + bank_angle - tdc
             current_crank_angle -= gap
 
 
@@ -184,22 +581,79 @@ class Engine:
         return n
 
     def generate_camshafts(self):
+        self.refresh_index()
+
+        for bank in self.banks:
+            bank.camshaft.lobes = array('d', [0.0]) * len(bank.cylinders)
+
         n_cylinders = len(self.firing_order)
         gap = 720 / n_cylinders
         for cylinder in self.firing_order:
-            bank = self.get_cylinder_bank(cylinder)
+            bank = self._cylinder_banks.get(cylinder)
 
-            firing_order_position = self.firing_order.index(cylinder)
+            firing_order_position = self._firing_positions[cylinder]
             lobe_index = bank.get_cylinder_index(cylinder)
 
             bank.camshaft.lobes[lobe_index] = firing_order_position * gap
 
-    def generate(self):
-        self.generate_rod_journals()
-        self.generate_camshafts()
+    def estimate_simulation_cost(self, model=None):
+        # Estimated CPU seconds engine-sim needs per simulated second
+        if model is None:
+            model = simulation_cost.CostModel()
 
-    def write_head(self, file):
-        file.write("""private node {} {{
+        return model.estimate(self)
+
+    def auto_tune(self, budget=1.0, model=None):
+        settings, cost = simulation_cost.tune(self, budget, model)
+        for name, value in settings.items():
+            setattr(self, name, value)
+
+        return cost
+
+    def set_geometry(self, rod_journals, lobes):
+        # Uses the given rod journals and per bank lobe tables, for example
+        # read back from a file, until the firing order or a bank changes
+        self._rod_journals = array('d', rod_journals)
+        for bank, table in zip(self.banks, lobes):
+            bank.camshaft.lobes = array('d', table)
+
+        self._geometry_key = self.geometry_key()
+
+    def generate(self):
+        # Derived geometry is refreshed automatically whenever it is read,
+        # calling this only forces a rebuild
+        self.invalidate_geometry()
+        self.refresh_geometry()
+
+    def format_number(self, value):
+        text = "{:.{}f}".format(value, self.compact_precision)
+        if "." in text:
+            text = text.rstrip("0").rstrip(".")
+
+        return "0" if text == "-0" else text
+
+    def cylinder_properties(self, cylinders):
+        # Sound attenuation, piston blowby and extra primary length of the
+        # given cylinders. With a seed the values only depend on the seed
+        # and the cylinder (see cylinder_random.py), without one they come
+        # from the global random state.
+        ranges = {"sound_attenuation": tuple(self.sound_attenuation_range)}
+        if self.piston_blowby_variation:
+            variation = self.piston_blowby * self.piston_blowby_variation
+            ranges["piston_blowby"] = (self.piston_blowby - variation, self.piston_blowby + variation)
+        if self.primary_length_variation:
+            ranges["primary_length"] = (0.0, self.primary_length_variation)
+
+        if self.seed is None:
+            values = {stream: [random.uniform(low, high) for cylinder in cylinders] for stream, (low, high) in ranges.items()}
+        else:
+            values = cylinder_random.uniform(self.seed, cylinders, ranges)
+
+        blowby = values.get("piston_blowby", [self.piston_blowby] * len(cylinders))
+        return values["sound_attenuation"], blowby, values.get("primary_length")
+
+    def iter_head(self):
+        yield """private node {} {{
     input intake_camshaft;
     input exhaust_camshaft;
     input chamber_volume: {} * units.cc;
@@ -213,7 +667,7 @@ class Engine:
     input flip_display: false;
     alias output __out: head;
 
-    function intake_flow(50 * units.thou)
+    function intake_flow({} * units.thou)
     intake_flow""".format(self.cylinder_head_node_name,
            self.chamber_volume,
            self.intake_runner_volume,
@@ -221,21 +675,18 @@ class Engine:
            self.intake_runner_cross_section[1],
            self.exhaust_runner_volume,
            self.exhaust_runner_cross_section[0],
-           self.exhaust_runner_cross_section[1]
-           ))
+           self.exhaust_runner_cross_section[1],
+           self.intake_flow_step
+           )
         
-        for i in range(len(self.intake_flow)):
-            file.write("\n")
-            file.write("    .add_flow_sample({} * lift_scale, {} * flow_attenuation)".format(i * 50, self.intake_flow[i]))
+        yield from FLOW_SAMPLE.rows([i * self.intake_flow_step for i in range(len(self.intake_flow))], self.intake_flow)
 
-        file.write("""\n\n    function exhaust_flow(50 * units.thou)
-    exhaust_flow""")
+        yield """\n\n    function exhaust_flow({} * units.thou)
+    exhaust_flow""".format(self.exhaust_flow_step)
         
-        for i in range(len(self.exhaust_flow)):
-            file.write("\n")
-            file.write("    .add_flow_sample({} * lift_scale, {} * flow_attenuation)".format(i * 50, self.exhaust_flow[i]))
+        yield from FLOW_SAMPLE.rows([i * self.exhaust_flow_step for i in range(len(self.exhaust_flow))], self.exhaust_flow)
 
-        file.write("""\n\n    generic_cylinder_head head(
+        yield """\n\n    generic_cylinder_head head(
         chamber_volume: chamber_volume,
         intake_runner_volume: intake_runner_volume,
         intake_runner_cross_section_area: intake_runner_cross_section_area,
@@ -251,10 +702,12 @@ class Engine:
         flip_display: flip_display
     )
 }\n
-""")
+"""
         
-    def write_camshaft(self, file):
-        file.write("""private node {} {{
+    def iter_camshaft(self):
+        self.refresh_geometry()
+
+        yield """private node {} {{
     input lobe_profile;
     input intake_lobe_profile: lobe_profile;
     input exhaust_lobe_profile: lobe_profile;
@@ -262,45 +715,54 @@ class Engine:
     input intake_lobe_center: lobe_separation;
     input exhaust_lobe_center: lobe_separation;  
     input advance: 0 * units.deg; 
-    input base_radius: {} * units.inch;""".format(self.camshaft_node_name, self.lobe_separation, self.camshaft_base_radius))
+    input base_radius: {} * units.inch;""".format(self.camshaft_node_name, self.lobe_separation, self.camshaft_base_radius)
 
         for index, bank in enumerate(self.banks):
-            file.write("\n")
-            file.write("    output intake_cam_{}: _intake_cam_{};\n".format(index, index))
-            file.write("    output exhaust_cam_{}: _exhaust_cam_{};\n".format(index, index))
+            yield "\n"
+            yield "    output intake_cam_{}: _intake_cam_{};\n".format(index, index)
+            yield "    output exhaust_cam_{}: _exhaust_cam_{};\n".format(index, index)
 
-        file.write(
-"""    camshaft_parameters params (
+        yield """    camshaft_parameters params (
         advance: advance,
         base_radius: base_radius
     )
-""")
+"""
         
         for index, bank in enumerate(self.banks):
-            file.write("\n")
-            file.write("    camshaft _intake_cam_{}(params, lobe_profile: intake_lobe_profile)\n".format(index))
-            file.write("    camshaft _exhaust_cam_{}(params, lobe_profile: exhaust_lobe_profile)\n".format(index))
-
-        file.write("    label rot360(360 * units.deg)\n")
-    
-        for index, bank in enumerate(self.banks):
-            file.write("    _exhaust_cam_{}\n".format(index))
-            for lobe in bank.camshaft.lobes:
-                file.write("        .add_lobe(rot360 - exhaust_lobe_center + {} * units.deg)\n".format(lobe))
+            yield "\n"
+            yield "    camshaft _intake_cam_{}(params, lobe_profile: intake_lobe_profile)\n".format(index)
+            yield "    camshaft _exhaust_cam_{}(params, lobe_profile: exhaust_lobe_profile)\n".format(index)
 
-            file.write("    _intake_cam_{}\n".format(index))
-            for lobe in bank.camshaft.lobes:
-                file.write("        .add_lobe(rot360 + exhaust_lobe_center + {} * units.deg)\n".format(lobe))
+        yield "    label rot360(360 * units.deg)\n"
 
-        file.write("}\n")
+        if self.compact:
+            yield "    label deg(units.deg)\n"
 
-    def write_engine(self, file):
-        file.write("""\npublic node {} {{
+        for index, bank in enumerate(self.banks):
+            yield "    _exhaust_cam_{}\n".format(index)
+            yield from self.iter_segment("lobe", (index, "exhaust"), len(bank.camshaft.lobes))
+            yield "    _intake_cam_{}\n".format(index)
+            yield from self.iter_segment("lobe", (index, "intake"), len(bank.camshaft.lobes))
+
+        yield "}\n"
+
+    def iter_lobe_rows(self, key, start, stop):
+        index, kind = key
+        lobes = self.banks[index].camshaft.lobes[start:stop]
+        if self.compact:
+            template = COMPACT_INTAKE_LOBE if kind == "intake" else COMPACT_EXHAUST_LOBE
+            yield from template.rows(map(self.format_number, lobes))
+        else:
+            template = INTAKE_LOBE if kind == "intake" else EXHAUST_LOBE
+            yield from template.rows(lobes)
+
+    def iter_engine(self):
+        yield """\npublic node {} {{
     alias output __out: engine;
 
-""".format(self.node_name))
+""".format(self.node_name)
         
-        file.write("""    engine engine(
+        yield """    engine engine(
         name: "{}",
         starter_torque: {} * units.lb_ft,
         starter_speed: {} * units.rpm,
@@ -313,17 +775,17 @@ class Engine:
         noise: {},
         jitter: {},
         simulation_frequency: {}
-    """.format(self.engine_name, self.starter_torque, self.starter_speed, self.redline, self.throttle_gamma, self.fuel.generate(), self.hf_gain, self.noise, self.jitter, self.simulation_frequency))
+    """.format(self.engine_name, self.starter_torque, self.starter_speed, self.redline, self.throttle_gamma, self.fuel.generate(), self.hf_gain, self.noise, self.jitter, self.simulation_frequency)
         
         if self.engine_sim_version[2] >= 13:
-            file.write(""",
+            yield """,
         fluid_simulation_steps: {},
         max_sle_solver_steps: {}
-        """, self.max_sle_solver_steps, self.fluid_simulation_steps)
+        """.format(self.fluid_simulation_steps, self.max_sle_solver_steps)
 
-        file.write(")\n\n    wires wires()\n")
+        yield ")\n\n    {} wires()\n".format(self.wires_node_name)
 
-        file.write("""
+        yield """
     label stroke({} * units.mm)
     label bore({} * units.mm)
     label rod_length({} * units.mm)
@@ -341,9 +803,9 @@ class Engine:
     )
     label other_moment( // Moment from cams, pulleys, etc [estimated]
         disk_moment_of_inertia(mass: 1 * units.kg, radius: 1.0 * units.cm)
-    )""".format(self.stroke, self.bore, self.rod_length, self.rod_mass, self.compression_height, self.crank_mass, self.flywheel_mass, self.flywheel_radius))
+    )""".format(self.stroke, self.bore, self.rod_length, self.rod_mass, self.compression_height, self.crank_mass, self.flywheel_mass, self.flywheel_radius)
 
-        file.write("""\n\n    crankshaft c0(
+        yield """\n\n    crankshaft c0(
         throw: stroke / 2,
         flywheel_mass: flywheel_mass,
         mass: crank_mass,
@@ -353,26 +815,25 @@ class Engine:
         position_x: 0.0,
         position_y: 0.0,
         tdc: {} * units.deg
-    )\n""".format(self.tdc()))
+    )\n""".format(self.tdc())
         
-        file.write("\n")
-        for index, journal in enumerate(self.rod_journals):
-            file.write("    rod_journal rj{}(angle: {} * units.deg)\n".format(index, journal))
+        yield "\n"
+        if self.compact:
+            yield "    label deg(units.deg)\n"
+        yield from self.iter_segment("rod_journal", None, len(self.rod_journals))
+        yield "    c0\n"
+        yield from self.iter_segment("add_rod_journal", None, len(self.rod_journals))
 
-        file.write("    c0\n")
-        for index, journal in enumerate(self.rod_journals):
-            file.write("        .add_rod_journal(rj{})\n".format(index))
+        yield "\n"
 
-        file.write("\n")
-
-        file.write("""    piston_parameters piston_params(
+        yield """    piston_parameters piston_params(
         mass: ({}) * units.g, // 414 - piston mass, 152 - pin weight
         compression_height: compression_height,
         wrist_pin_position: 0.0,
         displacement: 0.0
-    )\n\n""".format(self.piston_mass))
+    )\n\n""".format(self.piston_mass)
 
-        file.write("""    connecting_rod_parameters cr_params(
+        yield """    connecting_rod_parameters cr_params(
         mass: rod_mass,
         moment_of_inertia: rod_moment_of_inertia(
             mass: rod_mass,
@@ -380,9 +841,9 @@ class Engine:
         ),
         center_of_mass: 0.0,
         length: rod_length
-    )\n""")
+    )\n"""
         
-        file.write("""    intake intake(
+        yield """    intake intake(
         plenum_volume: {} * units.L,
         plenum_cross_section_area: {} * units.cm2,
         intake_flow_rate: k_carb({}),
@@ -391,63 +852,67 @@ class Engine:
         idle_flow_rate: k_carb({}),
         idle_throttle_plate_position: {},
         velocity_decay: 0.5
-    )\n""".format(self.plenum_volume, self.plenum_cross_section_area, self.intake_flow_rate, self.runner_flow_rate, self.runner_length, self.idle_flow_rate, self.idle_throttle_plate_position))
+    )\n""".format(self.plenum_volume, self.plenum_cross_section_area, self.intake_flow_rate, self.runner_flow_rate, self.runner_length, self.idle_flow_rate, self.idle_throttle_plate_position)
 
-        file.write("""    exhaust_system_parameters es_params(
+        yield """    exhaust_system_parameters es_params(
         outlet_flow_rate: k_carb(2000.0),
         primary_tube_length: 20.0 * units.inch,
         primary_flow_rate: k_carb(200.0),
         velocity_decay: 0.5
-    )\n""")
+    )\n"""
         
         for index, bank in enumerate(self.banks):
-            file.write("""    exhaust_system exhaust{}(
+            yield """    exhaust_system exhaust{}(
         es_params,
         audio_volume: 1.0 * 0.004,
         length: {} * units.inch,
         impulse_response: ir_lib.minimal_muffling_01
-    )\n\n""".format(index, self.exhaust_length))
+    )\n\n""".format(index, self.exhaust_length)
             
-        file.write("""    cylinder_bank_parameters bank_params(
+        yield """    cylinder_bank_parameters bank_params(
         bore: bore,
         deck_height: stroke / 2 + rod_length + compression_height
-    )\n\n""")
+    )\n\n"""
         
-        file.write("    label spacing(0.0)\n")
+        yield "    label spacing(0.0)\n"
+        if self.compact or self.piston_blowby_variation:
+            yield "    label piston_blowby(k_28inH2O({}))\n".format(self.piston_blowby)
+        if self.compact:
+            yield "    label primary_step(spacing * 0.5 * units.cm)\n"
+
+        # The per-cylinder variation settings, only when they differ from the
+        # defaults, so that mr_parser can render the same cylinders again
+        if self.piston_blowby_variation:
+            yield "    label piston_blowby_variation({})\n".format(self.piston_blowby_variation)
+        if self.primary_length_variation:
+            yield "    label primary_length_variation({})\n".format(self.primary_length_variation)
+        if list(self.sound_attenuation_range) != DEFAULT_SOUND_ATTENUATION_RANGE:
+            yield "    label sound_attenuation_low({})\n".format(self.sound_attenuation_range[0])
+            yield "    label sound_attenuation_high({})\n".format(self.sound_attenuation_range[1])
 
         for index, bank in enumerate(self.banks):
-            file.write("    cylinder_bank b{}(bank_params, angle: {} * units.deg)\n".format(index, bank.bank_angle))
+            yield "    cylinder_bank b{}(bank_params, angle: {} * units.deg)\n".format(index, bank.bank_angle)
 
         for index, bank in enumerate(self.banks):
-            file.write("    b{}\n".format(index))
-            for cylinder_index, cylinder in enumerate(bank.cylinders):
-                file.write("""        .add_cylinder(
-            piston: piston(piston_params, blowby: k_28inH2O({})),
-            connecting_rod: connecting_rod(cr_params),
-            rod_journal: rj{},
-            intake: intake,
-            exhaust_system: exhaust{},
-            ignition_wire: wires.wire{},
-            sound_attenuation: {},
-            primary_length: {} * spacing * 0.5 * units.cm
-        )\n""".format(self.piston_blowby, cylinder, index, cylinder, random.uniform(0.5, 1.0), cylinder_index))
-                
-            file.write("""        .set_cylinder_head(
+            yield "    b{}\n".format(index)
+            yield from self.iter_segment("cylinder", index, len(bank.cylinders))
+
+            yield """        .set_cylinder_head(
             {}(
                 intake_camshaft: camshaft.intake_cam_{},
                 exhaust_camshaft: camshaft.exhaust_cam_{},
                 flip_display: {},
                 flow_attenuation: 1.0)
-        )\n\n""".format(self.cylinder_head_node_name, index, index, "true" if bank.flip else "false"))
+        )\n\n""".format(self.cylinder_head_node_name, index, index, "true" if bank.flip else "false")
 
-        file.write("    engine\n")
+        yield "    engine\n"
         for index, bank in enumerate(self.banks):
-            file.write("        .add_cylinder_bank(b{})\n".format(index))
-        file.write("\n")
+            yield "        .add_cylinder_bank(b{})\n".format(index)
+        yield "\n"
 
-        file.write("    engine.add_crankshaft(c0)\n\n")
+        yield "    engine.add_crankshaft(c0)\n\n"
 
-        file.write("""    harmonic_cam_lobe intake_lobe(
+        yield """    harmonic_cam_lobe intake_lobe(
         duration_at_50_thou: {} * units.deg,
         gamma: {},
         lift: {} * units.thou,
@@ -459,40 +924,76 @@ class Engine:
         gamma: {},
         lift: {} * units.thou,
         steps: {}
-    )\n\n""".format(self.intake_lobe_duration, self.intake_lobe_gamma, self.intake_lobe_lift, self.intake_lobe_steps, self.exhaust_lobe_duration, self.exhaust_lobe_gamma, self.exhaust_lobe_lift, self.exhaust_lobe_steps))
+    )\n\n""".format(self.intake_lobe_duration, self.intake_lobe_gamma, self.intake_lobe_lift, self.intake_lobe_steps, self.exhaust_lobe_duration, self.exhaust_lobe_gamma, self.exhaust_lobe_lift, self.exhaust_lobe_steps)
         
-        file.write("""    {} camshaft(
+        yield """    {} camshaft(
         lobe_profile: "N/A",
 
         intake_lobe_profile: intake_lobe,
         exhaust_lobe_profile: exhaust_lobe,
         intake_lobe_center: {} * units.deg,
         exhaust_lobe_center: {} * units.deg
-    )\n\n""".format(self.camshaft_node_name, self.intake_lobe_center, self.exhaust_lobe_center))
+    )\n\n""".format(self.camshaft_node_name, self.intake_lobe_center, self.exhaust_lobe_center)
         
-        file.write("""    function timing_curve(1000 * units.rpm)
-    timing_curve""")
-        for point in self.timing_curve:
-            file.write("\n")
-            file.write("        .add_sample({} * units.rpm, {} * units.deg)".format(point[0], point[1]))
+        yield """    function timing_curve({} * units.rpm)
+    timing_curve""".format(self.timing_curve_step)
+        yield from TIMING_SAMPLE.rows([point[0] for point in self.timing_curve], [point[1] for point in self.timing_curve])
 
-        file.write("\n\n")
+        yield "\n\n"
 
-        file.write("""    ignition_module ignition_module(
+        yield """    ignition_module ignition_module(
         timing_curve: timing_curve,
         rev_limit: {} * units.rpm,
-        limiter_duration: 0.1)\n\n""".format(self.rev_limit, self.limiter_duration))
-
-        file.write("    ignition_module\n")
-        for index, cylinder in enumerate(self.firing_order):
-            file.write("            .connect_wire(wires.wire{}, {} * units.deg)\n".format(cylinder, 720 * (index / len(self.firing_order))))
-
-        file.write("\n    engine.add_ignition_module(ignition_module)\n")
-
-        file.write("}\n\n")
-
-    def write_vehicle_transmission(self, file):
-        file.write("""private node {} {{
+        limiter_duration: 0.1)\n\n""".format(self.rev_limit, self.limiter_duration)
+
+        yield "    ignition_module\n"
+        yield from self.iter_segment("connect_wire", None, len(self.firing_order))
+
+        yield "\n    engine.add_ignition_module(ignition_module)\n"
+
+        yield "}\n\n"
+
+    def iter_rod_journal_rows(self, key, start, stop):
+        journals = self.rod_journals[start:stop]
+        if self.compact:
+            yield from COMPACT_ROD_JOURNAL.rows(range(start, stop), map(self.format_number, journals))
+        else:
+            yield from ROD_JOURNAL.rows(range(start, stop), journals)
+
+    def iter_add_rod_journal_rows(self, key, start, stop):
+        yield from (COMPACT_ADD_ROD_JOURNAL if self.compact else ADD_ROD_JOURNAL).rows(range(start, stop))
+
+    def iter_cylinder_rows(self, key, start, stop):
+        # key is the bank index
+        cylinders = self.banks[key].cylinders[start:stop]
+        attenuation, blowby, primary_length = self.cylinder_properties(cylinders)
+        positions = range(start, stop)
+
+        if self.compact:
+            if self.piston_blowby_variation:
+                blowby = ["k_28inH2O({})".format(value) for value in blowby]
+            else:
+                blowby = itertools.repeat("piston_blowby")
+            extra_length = itertools.repeat("") if primary_length is None else ["+{}*units.cm".format(self.format_number(value)) for value in primary_length]
+            yield from COMPACT_CYLINDER.rows(blowby, cylinders, itertools.repeat(key), cylinders, map(self.format_number, attenuation), positions, extra_length)
+        else:
+            extra_length = itertools.repeat("") if primary_length is None else [" + {} * units.cm".format(value) for value in primary_length]
+            yield from CYLINDER.rows(blowby, cylinders, itertools.repeat(key), cylinders, attenuation, positions, extra_length)
+
+    def iter_connect_wire_rows(self, key, start, stop):
+        n_cylinders = len(self.firing_order)
+        angles = [720 * (index / n_cylinders) for index in range(start, stop)]
+        if self.compact:
+            yield from COMPACT_CONNECT_WIRE.rows(self.firing_order[start:stop], map(self.format_number, angles))
+        else:
+            yield from CONNECT_WIRE.rows(self.firing_order[start:stop], angles)
+
+    def iter_vehicle_transmission(self):
+        yield from self.iter_vehicle()
+        yield from self.iter_transmission()
+
+    def iter_vehicle(self):
+        yield """private node {} {{
     alias output __out:
         vehicle(
             mass: {} * units.kg,
@@ -511,22 +1012,21 @@ class Engine:
             self.vehicle.diff_ratio,
             self.vehicle.tire_radius,
             self.vehicle.rolling_resistance
-            ))
-        
-        file.write("""private node {} {{
+            )
+
+    def iter_transmission(self):
+        yield """private node {} {{
     alias output __out:
         transmission(
             max_clutch_torque: {} * units.lb_ft
-        )""".format(self.transmission.node_name, self.transmission.max_clutch_torque))
+        )""".format(self.transmission.node_name, self.transmission.max_clutch_torque)
         
-        for gear in self.transmission.gears:
-            file.write("\n")
-            file.write("    .add_gear({})".format(gear))
+        yield from GEAR.rows(self.transmission.gears)
         
-        file.write(";\n}\n\n")
+        yield ";\n}\n\n"
         
-    def write_main_node(self, file):
-        file.write("""public node main {{
+    def iter_main_node(self):
+        yield """public node main {{
     run(
         engine: {}(),
         vehicle: {}(),
@@ -534,37 +1034,386 @@ class Engine:
     )
 }}
 
-main()\n""".format(self.node_name, self.vehicle.node_name, self.transmission.node_name))
+main()\n""".format(self.node_name, self.vehicle.node_name, self.transmission.node_name)
 
-    def __write(self, file):
-        file.write(
-"""import "engine_sim.mr"
+    def iter_preamble(self):
+        yield """import "engine_sim.mr"
 
 units units()
 constants constants()
 impulse_response_library ir_lib()
             
-""")
-
-        file.write("private node wires {\n")
-        for cylinder in range(self.cylinder_count()):
-            file.write("    output wire{}: ignition_wire();\n".format(cylinder))
-        file.write("}\n\n")
-
-        self.write_head(file)
-        self.write_camshaft(file)
-        self.write_engine(file)
-        self.write_vehicle_transmission(file)
-        self.write_main_node(file)
-        
+"""
+
+    def iter_wires(self):
+        yield "private node {} {{\n".format(self.wires_node_name)
+        yield from self.iter_segment("wire", None, self.cylinder_count())
+        yield "}\n\n"
+
+    def iter_wire_rows(self, key, start, stop):
+        yield from (COMPACT_WIRE if self.compact else WIRE).rows(range(start, stop))
+
+    def iter_segment(self, name, key, count):
+        # Rows of a segment repeated for every cylinder, journal, lobe or
+        # wire, rendered by iter_<name>_rows(key, start, stop). During a
+        # parallel render large segments are split into slices rendered by
+        # the worker pool and reassembled in order.
+        if self._pool is None or count < 2 * self._pool[1]:
+            yield from getattr(self, "iter_{}_rows".format(name))(key, 0, count)
+            return
+
+        executor, task_rows = self._pool
+        futures = [executor.submit(_render_rows, name, key, start, min(start + task_rows, count)) for start in range(0, count, task_rows)]
+        for future in futures:
+            yield future.result()
+
+    def iter_section(self, name):
+        fragments = getattr(self, "iter_" + name)()
+        if self._stats is None:
+            return fragments
+
+        return self._stats.measure_fragments("write_" + name, fragments)
+
+    def iter_document(self):
+        self.check()
+        for name in self.SECTION_DEPENDENCIES:
+            yield from self.iter_section(name)
+
+    def iter_document_parallel(self, workers=None, threshold=PARALLEL_THRESHOLD):
+        # Same output as iter_document(), with the repeated segments of
+        # engines with at least threshold cylinders rendered on a pool of
+        # worker processes. Smaller engines render faster sequentially. So do
+        # engines without a seed, as their per-cylinder values come from the
+        # global random state the workers do not share.
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        if workers < 2 or self.seed is None or self.cylinder_count() < threshold:
+            yield from self.iter_document()
+            return
+
+        self.check()
+        self.refresh_geometry()
+        worker_engine = copy.copy(self)
+        worker_engine._stats = None
+        worker_engine._sections = {}
+
+        task_rows = max(MIN_TASK_ROWS, self.cylinder_count() // (workers * TASKS_PER_WORKER))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_start_worker, initargs=(worker_engine,)) as executor:
+            self._pool = (executor, task_rows)
+            try:
+                yield from self.iter_document()
+            finally:
+                self._pool = None
+
+    def instrument(self, callback=None, track_allocations=False):
+        # Starts collecting per phase statistics (see instrumentation.py) and
+        # returns them, engines that are not instrumented pay nothing for it
+        self.stop_instrumenting()
+        self._stats = instrumentation.RenderStats(callback, track_allocations)
+        return self._stats
+
+    def stop_instrumenting(self):
+        stats = self._stats
+        self._stats = None
+        if stats is not None:
+            stats.stop()
+        return stats
+
+    @property
+    def stats(self):
+        return self._stats
+
+    def render_chunks(self, chunk_size=DEFAULT_CHUNK_SIZE, workers=1):
+        # Groups the many small fragments produced by the writers into chunks
+        # of roughly chunk_size characters so that sinks see a few large
+        # writes and only one chunk is ever held in memory. workers other
+        # than 1 renders with iter_document_parallel(), None uses every core.
+        chunk = []
+        size = 0
+        fragments = self.iter_document() if workers == 1 else self.iter_document_parallel(workers)
+        for text in fragments:
+            chunk.append(text)
+            size += len(text)
+            if size >= chunk_size:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+
+        if chunk:
+            yield "".join(chunk)
+
+    def stream_to(self, sink, chunk_size=DEFAULT_CHUNK_SIZE, encoding=None, workers=1):
+        # sink is anything with a write() method (file, sys.stdout, gzip
+        # stream, subprocess pipe, ...) or a callable such as socket.sendall.
+        # Binary sinks need an encoding.
+        write = sink if callable(sink) else sink.write
+        for chunk in self.render_chunks(chunk_size, workers):
+            write(chunk if encoding is None else chunk.encode(encoding))
+
+    def write_head(self, file):
+        for text in self.iter_section("head"):
+            file.write(text)
+
+    def write_camshaft(self, file):
+        for text in self.iter_section("camshaft"):
+            file.write(text)
+
+    def write_engine(self, file):
+        for text in self.iter_section("engine"):
+            file.write(text)
+
+    def write_vehicle_transmission(self, file):
+        for text in self.iter_section("vehicle_transmission"):
+            file.write(text)
+
+    def write_main_node(self, file):
+        for text in self.iter_section("main_node"):
+            file.write(text)
+
+    def section_fingerprint(self, name):
+        self.refresh_geometry()
+
+        values = []
+        for dependency in self.SECTION_DEPENDENCIES[name]:
+            value = getattr(self, dependency)
+            if dependency == "banks":
+                value = [(bank.to_dict(), bank.camshaft.lobes) for bank in value]
+            elif hasattr(value, "to_dict"):
+                value = value.to_dict()
+            values.append(value)
+
+        # repr() takes a snapshot, so in-place edits of lists are detected too
+        return repr(values)
+
+    def render_section(self, name):
+        fingerprint = self.section_fingerprint(name)
+        cached = self._sections.get(name)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+
+        text = "".join(self.iter_section(name))
+
+        # Without a seed the engine section is different on every render
+        if name != "engine" or self.seed is not None:
+            self._sections[name] = (fingerprint, text)
+
+        return text
+
+    def dirty_sections(self):
+        dirty = []
+        for name in self.SECTION_DEPENDENCIES:
+            cached = self._sections.get(name)
+            if cached is None or cached[0] != self.section_fingerprint(name):
+                dirty.append(name)
+
+        return dirty
+
     def write_to_string(self):
-        file = io.StringIO()
-        self.__write(file)
-        return file.getvalue()
+        self.check()
+        return "".join(self.render_section(name) for name in self.SECTION_DEPENDENCIES)
 
     def write_to_console(self):
         print(self.write_to_string())
     
-    def write_to_file(self, fname):
-        with open(fname, 'w') as file:
-            self.__write(file)
+    def write_to_file(self, fname, chunk_size=DEFAULT_CHUNK_SIZE, atomic=False, workers=1):
+        # Checked before the file is opened, so an invalid engine leaves an
+        # existing file alone
+        self.check()
+        if not atomic:
+            with open(fname, 'w') as file:
+                self.stream_to(file, chunk_size, workers=workers)
+            return
+
+        # Rendered next to the target and moved over it once complete, so an
+        # interrupted render never leaves a truncated file behind
+        fd, temp_path = files.temp_file_for(fname)
+        try:
+            with os.fdopen(fd, 'w') as file:
+                self.stream_to(file, chunk_size, workers=workers)
+            os.replace(temp_path, fname)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+class EngineBatch:
+    # Struct of arrays store for many variants of one template engine. Every
+    # int/float parameter of the engine and of its fuel, vehicle and
+    # transmission ("vehicle.mass") is a column, everything else is shared
+    # with the template unless a row overrides it. Columns hold doubles
+    # whatever the type of the template value, so sweeping an int default
+    # such as bore with floats keeps the array. Which rows held an int is
+    # kept alongside, so rows come back with the types they went in with.
+    NESTED = ("fuel", "vehicle", "transmission")
+
+    # Counts and seeds, stored as 64 bit ints
+    INTEGER_PARAMETERS = (
+        "seed", "compact_precision", "intake_lobe_steps", "exhaust_lobe_steps",
+        "max_sle_solver_steps", "fluid_simulation_steps")
+
+    def __init__(self, template):
+        self.template = copy.deepcopy(template)
+        self.columns = {}
+        self.integers = {}
+        self.overrides = {}
+        self.size = 0
+
+        for name in self.parameter_names(self.template):
+            value = self.get_value(self.template, name)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                if name in self.INTEGER_PARAMETERS and isinstance(value, int):
+                    self.columns[name] = array('q')
+                else:
+                    self.columns[name] = array('d')
+                    self.integers[name] = bytearray()
+
+    @classmethod
+    def parameter_names(cls, engine):
+        for name in engine.__slots__:
+            # Banks and firing order are compared separately in append()
+            if name.startswith("_") or name == "banks":
+                continue
+            if name in cls.NESTED:
+                for nested_name in getattr(engine, name).__slots__:
+                    yield "{}.{}".format(name, nested_name)
+            else:
+                yield name
+
+    @staticmethod
+    def get_value(engine, name):
+        target = engine
+        for part in name.split("."):
+            target = getattr(target, part)
+        return target
+
+    @staticmethod
+    def set_value(engine, name, value):
+        target = engine
+        parts = name.split(".")
+        for part in parts[:-1]:
+            target = getattr(target, part)
+        setattr(target, parts[-1], value)
+
+    @staticmethod
+    def fits(column, value):
+        if column.typecode == 'q':
+            return type(value) is int and -2 ** 63 <= value < 2 ** 63
+        # Ints above 2^53 would not survive the round trip through a double
+        return isinstance(value, float) or (type(value) is int and abs(value) <= 2 ** 53)
+
+    def to_list(self, name):
+        # Falls back to a plain list for a column holding a value that does
+        # not fit, e.g. a string
+        column = self.columns[name]
+        flags = self.integers.pop(name, None)
+        if flags is None:
+            values = list(column)
+        else:
+            values = [int(value) if flag else value for value, flag in zip(column, flags)]
+        self.columns[name] = values
+        return values
+
+    def value(self, name, index):
+        value = self.columns[name][index]
+        flags = self.integers.get(name)
+        if flags is not None and flags[index]:
+            return int(value)
+        return value
+
+    @classmethod
+    def from_columns(cls, template, columns):
+        # Builds a batch directly from parameter columns, e.g. a sweep
+        # {"bore": [...], "stroke": [...]}, without creating any engines
+        batch = cls(template)
+
+        unknown = set(columns) - set(batch.columns)
+        if unknown:
+            raise ValueError("Unknown scalar parameters: {}".format(", ".join(sorted(unknown))))
+
+        lengths = set(len(values) for values in columns.values())
+        if len(lengths) > 1:
+            raise ValueError("Columns have different lengths")
+        size = lengths.pop() if lengths else 0
+
+        for name, column in batch.columns.items():
+            if name in columns:
+                values = list(columns[name])
+            else:
+                values = [batch.get_value(batch.template, name)] * size
+
+            if all(cls.fits(column, value) for value in values):
+                column.extend(values)
+                if name in batch.integers:
+                    batch.integers[name].extend(type(value) is int for value in values)
+            else:
+                batch.integers.pop(name, None)
+                batch.columns[name] = values
+
+        batch.size = size
+        return batch
+
+    def append(self, engine):
+        for name, column in self.columns.items():
+            value = self.get_value(engine, name)
+            if isinstance(column, array) and not self.fits(column, value):
+                # A value that would not survive the round trip through the
+                # array, e.g. a float in an int column
+                column = self.to_list(name)
+            column.append(value)
+            if name in self.integers:
+                self.integers[name].append(type(value) is int)
+
+        overrides = {}
+        for name in self.parameter_names(engine):
+            if name in self.columns:
+                continue
+            value = self.get_value(engine, name)
+            if value != self.get_value(self.template, name):
+                overrides[name] = copy.deepcopy(value)
+
+        if [bank.to_dict() for bank in engine.banks] != [bank.to_dict() for bank in self.template.banks]:
+            overrides["banks"] = copy.deepcopy(engine.banks)
+        if list(engine.firing_order) != list(self.template.firing_order):
+            overrides["firing_order"] = list(engine.firing_order)
+
+        if overrides:
+            self.overrides[self.size] = overrides
+
+        self.size += 1
+
+    def extend(self, engines):
+        for engine in engines:
+            self.append(engine)
+
+    def __len__(self):
+        return self.size
+
+    def column(self, name):
+        return self.columns[name]
+
+    def row(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("EngineBatch index out of range")
+
+        engine = copy.deepcopy(self.template)
+        engine.invalidate_geometry()
+        engine._sections = {}
+
+        for name in self.columns:
+            self.set_value(engine, name, self.value(name, index))
+
+        for name, value in self.overrides.get(index, {}).items():
+            self.set_value(engine, name, copy.deepcopy(value))
+
+        return engine
+
+    def __iter__(self):
+        for index in range(self.size):
+            yield self.row(index)
+
+    def render(self, index):
+        engine = self.row(index)
+        engine.generate()
+        return engine.write_to_string()
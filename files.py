@@ -0,0 +1,30 @@
+import os
+import tempfile
+
+# Temporary files that are moved over their target with os.replace() once
+# complete. mkstemp() creates them with mode 0600 and os.replace() keeps it,
+# so they get the mode of the file they replace, or the mode open(path, 'w')
+# would have given a new file.
+
+def default_mode():
+    # os.umask() can only be read by setting it
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+def temp_file_for(path):
+    # (fd, temp path) of a new file in the directory of path
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = default_mode()
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        os.fchmod(fd, mode)
+    except BaseException:
+        os.close(fd)
+        os.remove(temp_path)
+        raise
+
+    return fd, temp_path
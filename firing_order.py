@@ -0,0 +1,165 @@
+import concurrent.futures
+import os
+
+import numpy as np
+
+DEFAULT_WEIGHTS = {
+    "primary_force": 1.0,
+    "secondary_force": 0.5,
+    "primary_couple": 1.0,
+    "secondary_couple": 0.5,
+    "bank_interval": 1.0
+}
+
+class BankLayout:
+    def __init__(self, banks):
+        # Per cylinder geometry, cylinders are assumed to be numbered 0..n-1
+        # and to sit along the crank in the order they appear in their bank
+        n_cylinders = sum(len(bank.cylinders) for bank in banks)
+
+        self.n_cylinders = n_cylinders
+        self.tdc = 90 + banks[0].bank_angle
+        self.bank_angle = np.zeros(n_cylinders)
+        self.position = np.zeros(n_cylinders)
+        self.bank_members = []
+
+        for bank in banks:
+            cylinders = np.asarray(bank.cylinders, dtype=np.intp)
+            self.bank_angle[cylinders] = bank.bank_angle
+            self.position[cylinders] = np.arange(len(cylinders))
+            self.bank_members.append(cylinders)
+
+        axis = np.radians(self.bank_angle + 90)
+        self.axis = np.stack([np.cos(axis), np.sin(axis)])
+
+        self.position -= self.position.mean()
+        extent = np.abs(self.position).max()
+        self.lever = self.position / extent if extent > 0 else self.position
+
+def firing_positions(orders):
+    # Inverse permutation: position of every cylinder in each firing order
+    orders = np.asarray(orders, dtype=np.intp)
+    positions = np.empty_like(orders)
+    rows = np.arange(orders.shape[0])[:, None]
+    positions[rows, orders] = np.arange(orders.shape[1])
+    return positions
+
+def rod_journals(orders, layout):
+    # Same as Engine.generate_rod_journals() for a whole batch of firing orders
+    gap = 720 / layout.n_cylinders
+    return firing_positions(orders) * gap + (layout.bank_angle + 90) - layout.tdc
+
+def evaluate(orders, layout, weights=None):
+    if weights is None:
+        weights = DEFAULT_WEIGHTS
+
+    orders = np.atleast_2d(np.asarray(orders, dtype=np.intp))
+    n_cylinders = layout.n_cylinders
+    gap = 720 / n_cylinders
+
+    # Crank angle at which each piston reaches TDC, the reciprocating force of
+    # a cylinder along its bore axis goes as cos(k * (crank - phase)) for the
+    # k-th order
+    phase = np.radians((layout.bank_angle + 90) - rod_journals(orders, layout))
+
+    metrics = {}
+    for order, name in [(1, "primary"), (2, "secondary")]:
+        rotating = np.exp(1j * order * phase)
+        force = np.einsum('an,bn->ba', layout.axis, rotating)
+        couple = np.einsum('an,bn->ba', layout.axis * layout.lever, rotating)
+        metrics[name + "_force"] = np.sqrt((np.abs(force) ** 2).sum(axis=1)) / n_cylinders
+        metrics[name + "_couple"] = np.sqrt((np.abs(couple) ** 2).sum(axis=1)) / n_cylinders
+
+    # The ignition module spaces all sparks evenly, so overall firing is always
+    # uniform. What differs between orders is how evenly each bank (and thus
+    # each exhaust system) fires.
+    positions = firing_positions(orders)
+    deviation = np.zeros(orders.shape[0])
+    for members in layout.bank_members:
+        if len(members) < 2:
+            continue
+
+        times = np.sort(positions[:, members] * gap, axis=1)
+        intervals = np.diff(np.concatenate([times, times[:, :1] + 720], axis=1), axis=1)
+        ideal = 720 / len(members)
+        deviation += intervals.std(axis=1) / ideal
+    metrics["bank_interval"] = deviation / len(layout.bank_members)
+
+    metrics["score"] = sum(weights[name] * metrics[name] for name in weights)
+    return metrics
+
+def evaluate_engine(engine, weights=None):
+    layout = BankLayout(engine.banks)
+    metrics = evaluate([engine.firing_order], layout, weights)
+    return {name: float(values[0]) for name, values in metrics.items()}
+
+def swap_neighbours(order):
+    # Every firing order reachable by swapping two positions, position 0 is
+    # kept fixed as rotating a firing order does not change its balance
+    n = len(order)
+    i, j = np.triu_indices(n, k=1)
+    keep = i > 0
+    i, j = i[keep], j[keep]
+
+    neighbours = np.repeat(order[None, :], len(i), axis=0)
+    rows = np.arange(len(i))
+    neighbours[rows, i] = order[j]
+    neighbours[rows, j] = order[i]
+    return neighbours
+
+def local_search(layout, seed, weights=None, max_iterations=1000):
+    rng = np.random.default_rng(seed)
+    order = np.concatenate([[0], rng.permutation(np.arange(1, layout.n_cylinders))])
+    score = evaluate([order], layout, weights)["score"][0]
+
+    for _ in range(max_iterations):
+        neighbours = swap_neighbours(order)
+        if len(neighbours) == 0:
+            break
+
+        scores = evaluate(neighbours, layout, weights)["score"]
+        best = np.argmin(scores)
+        if scores[best] >= score - 1e-12:
+            break
+
+        order = neighbours[best]
+        score = scores[best]
+
+    return score, order
+
+def _search_chunk(banks, seeds, weights, max_iterations):
+    layout = BankLayout(banks)
+    return [local_search(layout, seed, weights, max_iterations) for seed in seeds]
+
+def search(banks, top=5, restarts=16, workers=None, seed=0, weights=None, max_iterations=1000):
+    # Steepest descent over pairwise swaps from random starting orders, the
+    # restarts are spread over a process pool. Returns the best distinct
+    # orders as (score, firing_order) pairs.
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    seeds = [seed + index for index in range(restarts)]
+    chunks = [seeds[index::workers] for index in range(workers) if seeds[index::workers]]
+
+    if workers == 1:
+        results = _search_chunk(banks, seeds, weights, max_iterations)
+    else:
+        results = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_search_chunk, banks, chunk, weights, max_iterations) for chunk in chunks]
+            for future in futures:
+                results += future.result()
+
+    best = []
+    seen = set()
+    for score, order in sorted(results, key=lambda result: result[0]):
+        key = tuple(int(cylinder) for cylinder in order)
+        if key in seen:
+            continue
+
+        seen.add(key)
+        best.append((float(score), list(key)))
+        if len(best) == top:
+            break
+
+    return best
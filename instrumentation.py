@@ -0,0 +1,133 @@
+import json
+import marshal
+import time
+import tracemalloc
+
+class PhaseStats:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall_time = 0.0
+        self.write_calls = 0
+        self.bytes = 0
+        self.allocated = 0
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "wall_time": self.wall_time,
+            "write_calls": self.write_calls,
+            "bytes": self.bytes,
+            "allocated": self.allocated
+        }
+
+class RenderStats:
+    # Per phase timings of an instrumented engine. callback(name, phase) is
+    # invoked every time a phase finishes. With track_allocations the growth of
+    # the traced heap during each phase is recorded as well, which includes
+    # whatever the consumer of a streamed section allocates in between.
+    # Tracing started here is stopped again by stop().
+    def __init__(self, callback=None, track_allocations=False):
+        self.callback = callback
+        self.track_allocations = track_allocations
+        self.phases = {}
+
+        # [baseline, peak] of every phase being measured. tracemalloc has a
+        # single peak, so before a nested phase resets it the peak so far is
+        # folded into the phases around it.
+        self.open_phases = []
+        self.started_tracing = False
+
+    def phase(self, name):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = PhaseStats(name)
+        return phase
+
+    def update_peaks(self):
+        peak = tracemalloc.get_traced_memory()[1]
+        for entry in self.open_phases:
+            entry[1] = max(entry[1], peak)
+
+    def start(self):
+        if not self.track_allocations:
+            return None
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        self.update_peaks()
+        tracemalloc.reset_peak()
+
+        current = tracemalloc.get_traced_memory()[0]
+        entry = [current, current]
+        self.open_phases.append(entry)
+        return entry
+
+    def finish(self, phase, entry):
+        phase.calls += 1
+        if entry is not None:
+            self.update_peaks()
+            self.open_phases.remove(entry)
+            phase.allocated += max(entry[1] - entry[0], 0)
+
+        if self.callback is not None:
+            self.callback(phase.name, phase)
+
+    def measure(self, name, function):
+        phase = self.phase(name)
+        entry = self.start()
+        start = time.perf_counter()
+        result = function()
+        phase.wall_time += time.perf_counter() - start
+        self.finish(phase, entry)
+        return result
+
+    def measure_fragments(self, name, fragments):
+        # Only the time spent producing fragments is counted, not the time the
+        # consumer takes to write them. Phases measured while a section is
+        # produced (the geometry refresh in the camshaft section) are counted
+        # in the section too.
+        phase = self.phase(name)
+        entry = self.start()
+        iterator = iter(fragments)
+        while True:
+            start = time.perf_counter()
+            try:
+                text = next(iterator)
+            except StopIteration:
+                phase.wall_time += time.perf_counter() - start
+                break
+            phase.wall_time += time.perf_counter() - start
+            phase.write_calls += 1
+            phase.bytes += len(text)
+            yield text
+
+        self.finish(phase, entry)
+
+    def stop(self):
+        # Stops tracemalloc if it was started for these statistics
+        self.open_phases = []
+        if self.started_tracing:
+            self.started_tracing = False
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    def reset(self):
+        self.phases = {}
+
+    def to_dict(self):
+        return {name: phase.to_dict() for name, phase in self.phases.items()}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def dump_stats(self, fname):
+        # Same format as cProfile.Profile.dump_stats(), so the file can be
+        # loaded with pstats.Stats or any cProfile viewer
+        entries = {}
+        for name, phase in self.phases.items():
+            entries[("engine_generator.py", 0, name)] = (phase.calls, phase.calls, phase.wall_time, phase.wall_time, {})
+
+        with open(fname, 'wb') as file:
+            marshal.dump(entries, file)
@@ -0,0 +1,244 @@
+import operator
+import re
+
+import numpy as np
+
+# Derived metrics for whole arrays of parameter sets, computed from the same
+# inputs and units the generator writes (mm, cc, g, kg, rpm, lb_ft), so that
+# infeasible variants of a sweep can be dropped before anything is generated
+
+LB_FT = 1.3558179483314004
+
+# The other_moment label of every engine node, a 1 kg disk of 1 cm radius
+OTHER_MOMENT = 0.5 * 1.0 * 0.01 ** 2
+
+PARAMETERS = [
+    "bore",
+    "stroke",
+    "chamber_volume",
+    "rod_length",
+    "redline",
+    "starter_torque",
+    "starter_speed",
+    "crank_mass",
+    "flywheel_mass",
+    "flywheel_radius"
+]
+
+OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne
+}
+
+COMPARISON = re.compile(r"\s*(<=|>=|==|!=|<|>)\s*")
+NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]*$")
+
+def cylinder_displacement(bore, stroke):
+    # cc
+    return np.pi / 4 * bore ** 2 * stroke / 1000
+
+def displacement(cylinder_displacement, cylinders):
+    # L
+    return cylinder_displacement * cylinders / 1000
+
+def compression_ratio(swept_volume, chamber_volume):
+    return (swept_volume + chamber_volume) / chamber_volume
+
+def mean_piston_speed(stroke, rpm):
+    # m/s
+    return 2 * stroke / 1000 * rpm / 60
+
+def rod_ratio(rod_length, stroke):
+    return rod_length / stroke
+
+def inertia(stroke, crank_mass, flywheel_mass, flywheel_radius):
+    # kg m^2, the crank_moment + flywheel_moment + other_moment of the engine
+    # node where disk_moment_of_inertia() is m r^2 / 2
+    return 0.5 * crank_mass * (stroke / 1000) ** 2 + 0.5 * flywheel_mass * (flywheel_radius / 1000) ** 2 + OTHER_MOMENT
+
+def spin_up_time(moment, starter_torque, starter_speed):
+    # Seconds for the starter to spin the rotating mass up to starter_speed,
+    # ignoring friction and compression
+    return moment * starter_speed * 2 * np.pi / 60 / (starter_torque * LB_FT)
+
+def firing_interval(cylinders):
+    # Crank degrees between firings of an evenly firing engine
+    return 720 / cylinders
+
+# Metric: (function, arguments), the arguments are parameters or metrics
+METRICS = {
+    "cylinder_displacement": (cylinder_displacement, ["bore", "stroke"]),
+    "displacement": (displacement, ["cylinder_displacement", "cylinders"]),
+    "compression_ratio": (compression_ratio, ["cylinder_displacement", "chamber_volume"]),
+    "mean_piston_speed": (mean_piston_speed, ["stroke", "redline"]),
+    "rod_ratio": (rod_ratio, ["rod_length", "stroke"]),
+    "inertia": (inertia, ["stroke", "crank_mass", "flywheel_mass", "flywheel_radius"]),
+    "spin_up_time": (spin_up_time, ["inertia", "starter_torque", "starter_speed"]),
+    "firing_interval": (firing_interval, ["cylinders"])
+}
+
+def compute(template, columns=None, names=None):
+    # {name: array} with one value per parameter set for the given metrics
+    # and parameters, by default all of METRICS, PARAMETERS and "cylinders".
+    # columns maps parameter names to arrays (e.g. EngineBatch.columns or
+    # grid_columns()), parameters without a column are taken from the
+    # template engine and a "cylinders" column overrides its cylinder count.
+    # Only what the requested names depend on is computed.
+    if columns is None:
+        columns = {}
+    if names is None:
+        names = list(METRICS) + PARAMETERS + ["cylinders"]
+
+    size = len(next(iter(columns.values()))) if columns else 1
+    values = {}
+
+    def value(name):
+        if name not in values:
+            if name in METRICS:
+                function, arguments = METRICS[name]
+                values[name] = function(*[value(argument) for argument in arguments])
+            elif name in columns:
+                values[name] = np.asarray(columns[name], dtype=float)
+            elif name == "cylinders":
+                values[name] = float(template.cylinder_count())
+            elif name in PARAMETERS:
+                # Scalar, broadcast against the columns
+                values[name] = float(getattr(template, name))
+            else:
+                raise ValueError("Unknown metric '{}'".format(name))
+
+        return values[name]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {name: np.broadcast_to(value(name), (size,)) for name in names}
+
+def compute_batch(batch, names=None):
+    # Metrics of every row of an EngineBatch
+    columns = {name: batch.columns[name] for name in PARAMETERS if name in batch.columns}
+
+    cylinders = np.full(len(batch), batch.template.cylinder_count())
+    for index, overrides in batch.overrides.items():
+        if "banks" in overrides:
+            cylinders[index] = sum(len(bank.cylinders) for bank in overrides["banks"])
+    columns["cylinders"] = cylinders
+
+    return compute(batch.template, columns, names)
+
+def operand(text):
+    try:
+        return float(text)
+    except ValueError:
+        pass
+
+    if not NAME.match(text):
+        raise ValueError("Invalid filter operand '{}'".format(text))
+    return text
+
+def parse_filter(text):
+    # "mean_piston_speed < 25" or a chain such as "8 <= compression_ratio <= 13"
+    # into [(left, operator, right)]
+    parts = COMPARISON.split(text.strip())
+    if len(parts) < 3:
+        raise ValueError("Invalid filter '{}'".format(text))
+
+    operands = [operand(part) for part in parts[0::2]]
+    return [(operands[index], parts[2 * index + 1], operands[index + 1]) for index in range(len(operands) - 1)]
+
+def parse_filters(filters):
+    # filters is a filter expression, a list of them or a {name: [low, high]}
+    # table of inclusive bounds where either bound may be None
+    if isinstance(filters, (str, dict)):
+        filters = [filters]
+
+    comparisons = []
+    for expression in filters:
+        if isinstance(expression, dict):
+            for name, (low, high) in expression.items():
+                if low is not None:
+                    comparisons.append((name, ">=", float(low)))
+                if high is not None:
+                    comparisons.append((name, "<=", float(high)))
+        else:
+            comparisons.extend(parse_filter(expression))
+
+    return comparisons
+
+def filter_names(filters):
+    names = []
+    for comparison in parse_filters(filters):
+        for name in (comparison[0], comparison[2]):
+            if isinstance(name, str) and name not in names:
+                names.append(name)
+    return names
+
+def mask(values, filters):
+    # Boolean array of the parameter sets that pass every filter, see
+    # parse_filters(). NaN fails every comparison but !=.
+    keep = None
+    for left, comparison, right in parse_filters(filters):
+        for name in (left, right):
+            if isinstance(name, str) and name not in values:
+                raise ValueError("Unknown metric '{}'".format(name))
+
+        passed = OPERATORS[comparison](values.get(left, left), values.get(right, right))
+        keep = passed.copy() if keep is None else keep & passed
+
+    if keep is None:
+        size = len(next(iter(values.values()))) if values else 1
+        keep = np.ones(size, dtype=bool)
+
+    return keep
+
+def bank_cylinders(banks):
+    # Cylinder count of a list of Bank objects or bank dicts
+    return sum(len(bank["cylinders"] if isinstance(bank, dict) else bank.cylinders) for bank in banks)
+
+def axis_column(shape, dimension, values):
+    view = [1] * len(shape)
+    view[dimension] = len(values)
+    return np.broadcast_to(values.reshape(view), shape).ravel()
+
+def grid_columns(axes):
+    # Columns of the numeric axes for every point of symmetry.grid(axes), in
+    # the same order (first axis slowest). A "banks" axis gives the
+    # "cylinders" column, other axes get no column.
+    shape = [len(axis) for axis in axes.values()]
+    columns = {}
+    for dimension, (name, axis) in enumerate(axes.items()):
+        if name == "banks":
+            columns["cylinders"] = axis_column(shape, dimension, np.array([bank_cylinders(banks) for banks in axis], dtype=float))
+            continue
+
+        # Lists such as firing orders or flow tables get no column either,
+        # NumPy refuses lists of different lengths
+        try:
+            axis = np.asarray(axis)
+        except ValueError:
+            continue
+        if axis.ndim == 1 and axis.dtype.kind in "iuf":
+            columns[name] = axis_column(shape, dimension, axis)
+
+    return columns
+
+def grid_mask(template, axes, filters):
+    # Which points of symmetry.grid(axes) pass the filters, computing only
+    # the metrics they use
+    columns = grid_columns(axes)
+    size = 1
+    for axis in axes.values():
+        size *= len(axis)
+
+    values = compute(template, columns, filter_names(filters))
+    return np.broadcast_to(mask(values, filters), (size,))
+
+def grid_points(axes, indices):
+    # (index, point) for the given flat indices into symmetry.grid(axes)
+    names = list(axes)
+    shape = [len(axis) for axis in axes.values()]
+    for index in indices:
+        coordinates = np.unravel_index(index, shape)
+        yield int(index), {name: axes[name][int(coordinate)] for name, coordinate in zip(names, coordinates)}
@@ -0,0 +1,486 @@
+import glob
+import os
+import re
+
+import batch
+import engine_generator
+
+TOKEN = re.compile(r"""
+    (?P<space>\s+|//[^\n]*)
+    |(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+    |(?P<string>"[^"\n]*")
+    |(?P<name>[A-Za-z_][A-Za-z_0-9]*)
+    |(?P<symbol>[(){}:;,.*/+\-])
+    |(?P<error>.)
+""", re.VERBOSE)
+
+READ_SIZE = 64 * 1024
+
+END = (None, None)
+LOOKAHEAD = 3
+
+def scan(text):
+    # Unexpected characters become "error" tokens that the parser rejects
+    return [(match.lastgroup, match.group()) for match in TOKEN.finditer(text) if match.lastgroup != "space"]
+
+def tokenize(chunks):
+    # Yields lists of (kind, text) tokens from an iterable of text chunks. No
+    # token other than whitespace spans a line break, so each chunk is
+    # scanned up to its last line break and the rest waits for the next one.
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        cut = buffer.rfind("\n") + 1
+        if cut:
+            yield scan(buffer[:cut])
+            buffer = buffer[cut:]
+
+    yield scan(buffer)
+
+def read_chunks(path, size=READ_SIZE):
+    with open(path) as file:
+        while True:
+            chunk = file.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+class Parser:
+    # Recursive descent parser for the subset of the .mr language written by
+    # Engine. Expressions become tuples:
+    #   ("num", value), ("str", text), ("name", "units.deg"), ("bool", value)
+    #   ("neg", expr), ("op", operator, left, right)
+    #   ("call", base, [(method, [(keyword or None, expr), ...]), ...])
+    # where "b0.add_cylinder(...).set_cylinder_head(...)" is a call on base
+    # "b0" and "k_carb(400)" a call on base "".
+    def __init__(self, batches):
+        self.batches = iter(batches)
+        self.tokens = []
+        self.position = 0
+        self.fill()
+
+    def fill(self):
+        # Drops the tokens already consumed and reads batches until at least
+        # LOOKAHEAD tokens are ahead, the input is padded with END tokens
+        del self.tokens[:self.position]
+        self.position = 0
+
+        while len(self.tokens) <= LOOKAHEAD:
+            batch = next(self.batches, None)
+            if batch is None:
+                self.tokens += [END] * (LOOKAHEAD + 1)
+                return
+            self.tokens += batch
+
+    def peek(self, distance=0):
+        return self.tokens[self.position + distance]
+
+    def next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        if self.position + LOOKAHEAD >= len(self.tokens):
+            self.fill()
+        return token
+
+    def expect(self, text):
+        kind, token = self.next()
+        if token != text:
+            raise ValueError("Expected {!r} but found {!r}".format(text, token))
+
+    def accept(self, text):
+        if self.peek()[1] == text:
+            self.next()
+            return True
+        return False
+
+    def name(self):
+        kind, token = self.next()
+        if kind != "name":
+            raise ValueError("Expected a name but found {!r}".format(token))
+        return token
+
+    def iter_nodes(self):
+        # Yields ("node", public, name, statements) for every node definition
+        # and ("statement", statement) for everything else at the top level,
+        # one at a time so only a single node is ever held in memory
+        while self.peek()[0] is not None:
+            token = self.peek()[1]
+            if token in ("public", "private") and self.peek(1)[1] == "node":
+                self.next()
+                self.next()
+                name = self.name()
+                self.expect("{")
+                statements = []
+                while not self.accept("}"):
+                    statements.append(self.statement())
+                yield "node", token == "public", name, statements
+            else:
+                yield "statement", self.statement()
+
+    def statement(self):
+        kind, token = self.peek()
+        if token == "import":
+            self.next()
+            statement = ("import", self.next()[1][1:-1])
+        elif token in ("input", "output"):
+            self.next()
+            name = self.name()
+            value = self.expression() if self.accept(":") else None
+            statement = (token, name, value)
+        elif token == "alias":
+            self.next()
+            self.expect("output")
+            name = self.name()
+            self.expect(":")
+            statement = ("alias", name, self.expression())
+        elif token in ("label", "function") and self.peek(1)[0] == "name" and self.peek(2)[1] == "(":
+            self.next()
+            name = self.name()
+            self.expect("(")
+            value = self.expression()
+            self.expect(")")
+            statement = (token, name, value)
+        elif kind == "name" and self.peek(1)[0] == "name":
+            node_type = self.name()
+            name = self.name()
+            statement = ("instance", node_type, name, self.arguments())
+        else:
+            statement = ("expression", self.expression())
+
+        self.accept(";")
+        return statement
+
+    def arguments(self):
+        self.expect("(")
+        arguments = []
+        while not self.accept(")"):
+            keyword = None
+            if self.peek()[0] == "name" and self.peek(1)[1] == ":":
+                keyword = self.name()
+                self.next()
+            arguments.append((keyword, self.expression()))
+            self.accept(",")
+
+        return arguments
+
+    def expression(self):
+        left = self.term()
+        while self.peek()[1] in ("+", "-"):
+            operator = self.next()[1]
+            left = ("op", operator, left, self.term())
+        return left
+
+    def term(self):
+        left = self.factor()
+        while self.peek()[1] in ("*", "/"):
+            operator = self.next()[1]
+            left = ("op", operator, left, self.factor())
+        return left
+
+    def factor(self):
+        kind, token = self.next()
+        if kind == "number":
+            return ("num", float(token) if any(c in token for c in ".eE") else int(token))
+        elif kind == "string":
+            return ("str", token[1:-1])
+        elif token == "-":
+            return ("neg", self.factor())
+        elif token == "(":
+            value = self.expression()
+            self.expect(")")
+            return value
+        elif kind == "name":
+            if token in ("true", "false"):
+                return ("bool", token == "true")
+
+            parts = [token]
+            while self.peek()[1] == "." and self.peek(2)[1] != "(":
+                self.next()
+                parts.append(self.name())
+
+            if self.peek()[1] == "." and self.peek(1)[0] == "name":
+                self.next()
+                parts.append(self.name())
+
+            if self.peek()[1] != "(":
+                return ("name", ".".join(parts))
+
+            calls = [(parts[-1], self.arguments())]
+            while self.peek()[1] == "." and self.peek(1)[0] == "name" and self.peek(2)[1] == "(":
+                self.next()
+                method = self.name()
+                calls.append((method, self.arguments()))
+            return ("call", ".".join(parts[:-1]), calls)
+
+        raise ValueError("Unexpected {!r}".format(token))
+
+def number(expression):
+    # Leading literal of a value with units: "86 * units.mm", "(50) * units.g",
+    # "k_carb(400)" and "-45 * units.deg" give 86, 50, 400 and -45
+    kind = expression[0]
+    if kind == "num":
+        return expression[1]
+    elif kind == "neg":
+        return -number(expression[1])
+    elif kind == "op":
+        return number(expression[2])
+    elif kind == "call":
+        return number(expression[2][0][1][0][1])
+
+    raise ValueError("Expected a number but found {}".format(expression))
+
+def numbers(expression):
+    # Every literal in a value, "1.75 * units.inch * 2 * units.inch" gives
+    # [1.75, 2]
+    kind = expression[0]
+    if kind == "num":
+        return [expression[1]]
+    elif kind == "neg":
+        return [-value for value in numbers(expression[1])]
+    elif kind == "op":
+        return numbers(expression[2]) + numbers(expression[3])
+
+    return []
+
+def keywords(arguments):
+    return {keyword: value for keyword, value in arguments if keyword is not None}
+
+def suffix(name, prefix):
+    return int(name[len(prefix):])
+
+class EngineReader:
+    # Rebuilds an Engine from the nodes of one document. The sound
+    # attenuation, blowby and extra primary length of every cylinder are
+    # random in the generator and are kept in sound_attenuation,
+    # piston_blowby and primary_length rather than on the engine.
+    def __init__(self):
+        self.parameters = {"fuel": {}, "vehicle": {}, "transmission": {}}
+        self.sound_attenuation = {}
+        self.piston_blowby = {}
+        self.primary_length = {}
+        self.rod_journals = {}
+        self.lobe_tables = {}
+        self.banks = {}
+        self.firing_order = []
+
+    def read(self, chunks):
+        for item in Parser(tokenize(chunks)).iter_nodes():
+            if item[0] == "node":
+                self.read_node(item[2], item[3])
+
+        return self.build()
+
+    def read_node(self, name, statements):
+        kinds = {(statement[0], statement[1]) for statement in statements if statement[0] != "expression"}
+        if ("alias", "__out") in kinds:
+            value = [statement[2] for statement in statements if statement[0] == "alias"][0]
+            if value[0] == "name" and value[1] == "head":
+                self.read_head(name, statements)
+            elif value[0] == "name" and value[1] == "engine":
+                self.read_engine(name, statements)
+            elif value[0] == "call" and value[2][0][0] == "vehicle":
+                self.read_vehicle(name, value)
+            elif value[0] == "call" and value[2][0][0] == "transmission":
+                self.read_transmission(name, value)
+        elif ("instance", "camshaft_parameters") in kinds:
+            self.read_camshaft(name, statements)
+
+    def read_head(self, name, statements):
+        parameters = self.parameters
+        parameters["cylinder_head_node_name"] = name
+        for statement in statements:
+            if statement[0] == "input" and statement[2] is not None:
+                input_name, value = statement[1], statement[2]
+                if input_name in ("chamber_volume", "intake_runner_volume", "exhaust_runner_volume"):
+                    parameters[input_name] = number(value)
+                elif input_name in ("intake_runner_cross_section_area", "exhaust_runner_cross_section_area"):
+                    parameters[input_name[:-len("_area")]] = numbers(value)
+            elif statement[0] == "function":
+                parameters[statement[1] + "_step"] = number(statement[2])
+            elif statement[0] == "expression" and statement[1][0] == "call":
+                base, calls = statement[1][1], statement[1][2]
+                parameters[base] = [number(arguments[1][1]) for method, arguments in calls]
+
+    def read_camshaft(self, name, statements):
+        parameters = self.parameters
+        parameters["camshaft_node_name"] = name
+        for statement in statements:
+            if statement[0] == "input" and statement[1] == "lobe_separation":
+                parameters["lobe_separation"] = number(statement[2])
+            elif statement[0] == "input" and statement[1] == "base_radius":
+                parameters["camshaft_base_radius"] = number(statement[2])
+            elif statement[0] == "expression" and statement[1][1].startswith("_exhaust_cam_"):
+                # Lobes are "rot360 - exhaust_lobe_center + <angle> * units.deg"
+                lobes = [number(arguments[0][1][3]) for method, arguments in statement[1][2]]
+                self.lobe_tables[suffix(statement[1][1], "_exhaust_cam_")] = lobes
+
+    def read_engine(self, name, statements):
+        parameters = self.parameters
+        parameters["node_name"] = name
+        labels = {}
+        for statement in statements:
+            kind = statement[0]
+            if kind == "label":
+                labels[statement[1]] = statement[2]
+                if statement[1] in ("stroke", "bore", "rod_length", "rod_mass", "compression_height", "crank_mass", "flywheel_mass", "flywheel_radius"):
+                    parameters[statement[1]] = number(statement[2])
+                elif statement[1] in ("piston_blowby", "piston_blowby_variation", "primary_length_variation"):
+                    parameters[statement[1]] = number(statement[2])
+                elif statement[1] == "sound_attenuation_low":
+                    parameters.setdefault("sound_attenuation_range", list(engine_generator.DEFAULT_SOUND_ATTENUATION_RANGE))[0] = number(statement[2])
+                elif statement[1] == "sound_attenuation_high":
+                    parameters.setdefault("sound_attenuation_range", list(engine_generator.DEFAULT_SOUND_ATTENUATION_RANGE))[1] = number(statement[2])
+                elif statement[1] == "deg":
+                    parameters["compact"] = True
+            elif kind == "function" and statement[1] == "timing_curve":
+                parameters["timing_curve_step"] = number(statement[2])
+            elif kind == "instance":
+                self.read_instance(statement[1], statement[2], statement[3])
+            elif kind == "expression" and statement[1][0] == "call":
+                self.read_calls(statement[1][1], statement[1][2])
+
+    def read_instance(self, node_type, name, arguments):
+        parameters = self.parameters
+        values = keywords(arguments)
+        if node_type == "engine":
+            parameters["engine_name"] = values["name"][1]
+            for key in ("starter_torque", "starter_speed", "redline", "throttle_gamma", "hf_gain", "noise", "jitter", "simulation_frequency"):
+                parameters[key] = number(values[key])
+
+            for key, value in keywords(values["fuel"][2][0][1]).items():
+                parameters["fuel"][key] = number(value)
+
+            # Only written for engine-sim 0.1.13 and later
+            if "fluid_simulation_steps" in values:
+                parameters["fluid_simulation_steps"] = number(values["fluid_simulation_steps"])
+                parameters["max_sle_solver_steps"] = number(values["max_sle_solver_steps"])
+                parameters["engine_sim_version"] = [0, 1, 13, 0]
+        elif name == "wires" and not arguments:
+            parameters["wires_node_name"] = node_type
+        elif node_type == "rod_journal":
+            self.rod_journals[suffix(name, "rj")] = number(values["angle"])
+        elif node_type == "piston_parameters":
+            parameters["piston_mass"] = number(values["mass"])
+        elif node_type == "intake":
+            for key in ("plenum_volume", "plenum_cross_section_area", "intake_flow_rate", "runner_flow_rate", "runner_length", "idle_flow_rate", "idle_throttle_plate_position"):
+                parameters[key] = number(values[key])
+        elif node_type == "exhaust_system":
+            parameters["exhaust_length"] = number(values["length"])
+        elif node_type == "cylinder_bank":
+            self.banks[suffix(name, "b")] = {"cylinders": [], "bank_angle": number(values["angle"]), "flip": False}
+        elif node_type == "harmonic_cam_lobe":
+            kind = name[:-len("_lobe")]
+            parameters[kind + "_lobe_duration"] = number(values["duration_at_50_thou"])
+            parameters[kind + "_lobe_gamma"] = number(values["gamma"])
+            parameters[kind + "_lobe_lift"] = number(values["lift"])
+            parameters[kind + "_lobe_steps"] = number(values["steps"])
+        elif node_type == "ignition_module":
+            parameters["rev_limit"] = number(values["rev_limit"])
+            parameters["limiter_duration"] = number(values["limiter_duration"])
+        elif name == "camshaft":
+            parameters["intake_lobe_center"] = number(values["intake_lobe_center"])
+            parameters["exhaust_lobe_center"] = number(values["exhaust_lobe_center"])
+
+    def read_calls(self, base, calls):
+        if base == "timing_curve":
+            self.parameters["timing_curve"] = [[number(arguments[0][1]), number(arguments[1][1])] for method, arguments in calls]
+        elif base == "ignition_module":
+            self.firing_order = [suffix(arguments[0][1][1], "wires.wire") for method, arguments in calls]
+        elif base[:1] == "b" and base[1:].isdigit():
+            bank = self.banks[suffix(base, "b")]
+            for method, arguments in calls:
+                values = keywords(arguments)
+                if method == "add_cylinder":
+                    cylinder = suffix(values["rod_journal"][1], "rj")
+                    bank["cylinders"].append(cylinder)
+                    self.sound_attenuation[cylinder] = number(values["sound_attenuation"])
+
+                    # "piston_blowby" in the compact form without variation,
+                    # the blowby label comes first when there is variation
+                    blowby = keywords(values["piston"][2][0][1])["blowby"]
+                    if blowby[0] == "call":
+                        self.piston_blowby[cylinder] = number(blowby)
+                        self.parameters.setdefault("piston_blowby", self.piston_blowby[cylinder])
+
+                    # "<position> * spacing * 0.5 * units.cm + <extra> * units.cm"
+                    length = values["primary_length"]
+                    if length[0] == "op" and length[1] == "+":
+                        self.primary_length[cylinder] = number(length[3])
+                elif method == "set_cylinder_head":
+                    bank["flip"] = keywords(arguments[0][1][2][0][1])["flip_display"][1]
+
+    def read_vehicle(self, name, value):
+        vehicle = self.parameters["vehicle"]
+        vehicle["node_name"] = name
+        for key, argument in keywords(value[2][0][1]).items():
+            vehicle[key] = numbers(argument) if key == "cross_sectional_area" else number(argument)
+
+    def read_transmission(self, name, value):
+        transmission = self.parameters["transmission"]
+        transmission["node_name"] = name
+        transmission["max_clutch_torque"] = number(keywords(value[2][0][1])["max_clutch_torque"])
+        transmission["gears"] = [number(arguments[0][1]) for method, arguments in value[2][1:]]
+
+    def build(self):
+        parameters = dict(self.parameters)
+        parameters["banks"] = [self.banks[index] for index in sorted(self.banks)]
+        parameters["firing_order"] = self.firing_order
+        engine = engine_generator.Engine.from_dict(parameters)
+
+        journals = [self.rod_journals[index] for index in sorted(self.rod_journals)]
+        lobes = [self.lobe_tables[index] for index in range(len(engine.banks))]
+        engine.set_geometry(journals, lobes)
+
+        return engine
+
+def loads(text):
+    return EngineReader().read([text])
+
+def load(path):
+    return EngineReader().read(read_chunks(path))
+
+def _load_chunk(paths):
+    return [(path, load(path)) for path in paths]
+
+def iter_directory(directory, pattern="*.mr", workers=1, chunksize=16):
+    # Yields (path, engine) for every matching file, parsing each one only
+    # when it is reached. With more than one worker the files are parsed on a
+    # process pool in the order they are listed.
+    paths = sorted(glob.iglob(os.path.join(directory, pattern)))
+    if workers == 1:
+        for path in paths:
+            yield path, load(path)
+    else:
+        yield from batch.map_chunks(_load_chunk, paths, (), workers, chunksize)
+
+class Library:
+    # Read only mapping from file name (without .mr) to engine over a
+    # directory of generated files. Engines are parsed on every access and
+    # never cached, so libraries of any size can be scanned.
+    def __init__(self, directory, pattern="*.mr"):
+        self.directory = directory
+        self.pattern = pattern
+
+    def path_for(self, name):
+        return os.path.join(self.directory, name + ".mr")
+
+    def names(self):
+        return sorted(os.path.splitext(os.path.basename(path))[0] for path in glob.iglob(os.path.join(self.directory, self.pattern)))
+
+    def __len__(self):
+        return len(self.names())
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __contains__(self, name):
+        return os.path.exists(self.path_for(name))
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        return load(self.path_for(name))
+
+    def items(self):
+        for name in self.names():
+            yield name, load(self.path_for(name))
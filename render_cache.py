@@ -0,0 +1,146 @@
+import os
+import shutil
+
+import files
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def to_dict(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate()
+        }
+
+class RenderCache:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.entries())
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + ".mr")
+
+    def entries(self):
+        for name in os.listdir(self.directory):
+            if not name.endswith(".mr"):
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            yield path, stat.st_size, stat.st_mtime
+
+    def lookup(self, key):
+        path = self.path_for(key)
+        try:
+            # The modification time doubles as the LRU timestamp
+            os.utime(path)
+        except FileNotFoundError:
+            self.stats.misses += 1
+            return None
+
+        self.stats.hits += 1
+        return path
+
+    def get(self, key):
+        path = self.lookup(key)
+        if path is None:
+            return None
+
+        with open(path, 'r') as file:
+            return file.read()
+
+    def put(self, key, text):
+        # Written to a temporary file first so that concurrent readers never
+        # see a partially written entry
+        path = self.path_for(key)
+        fd, temp_path = files.temp_file_for(path)
+        with os.fdopen(fd, 'w') as file:
+            file.write(text)
+        try:
+            # Replacing an entry frees its old size
+            self.size -= os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+        os.replace(temp_path, path)
+
+        self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        self.size = sum(size for _, size, _ in entries)
+
+        for path, size, _ in entries:
+            if self.size <= self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            self.size -= size
+            self.stats.evictions += 1
+
+    def clear(self):
+        for path, _, _ in list(self.entries()):
+            os.remove(path)
+        self.size = 0
+
+    def render(self, engine):
+        # Without a seed the output is different on every render, so there is
+        # nothing that could be reused
+        if engine.seed is None:
+            self.stats.bypasses += 1
+            engine.generate()
+            return engine.write_to_string()
+
+        key = engine.spec_hash()
+        text = self.get(key)
+        if text is None:
+            text = self.render_and_store(engine, key)
+
+        return text
+
+    def render_and_store(self, engine, key):
+        engine.generate()
+        text = engine.write_to_string()
+        self.put(key, text)
+        return text
+
+    def write_to_file(self, engine, fname):
+        if engine.seed is None:
+            text = self.render(engine)
+        else:
+            key = engine.spec_hash()
+            path = self.lookup(key)
+            if path is not None:
+                shutil.copyfile(path, fname)
+                return
+
+            text = self.render_and_store(engine, key)
+
+        with open(fname, 'w') as file:
+            file.write(text)
@@ -0,0 +1,261 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import time
+
+import engine_generator
+
+MAX_BODY_SIZE = 16 * 1024 * 1024
+LATENCY_WINDOW = 1024
+
+WORKER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+def render_parameters(parameters):
+    # Runs in a worker process
+    return engine_generator.Engine.from_dict(parameters).write_to_string()
+
+def request_key(parameters):
+    spec = {"generator_version": engine_generator.GENERATOR_VERSION, "engine": parameters}
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()
+
+class LRUCache:
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        text = self.entries.get(key)
+        if text is not None:
+            self.entries.move_to_end(key)
+        return text
+
+    def put(self, key, text):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+
+        self.entries[key] = text
+        self.size += len(text)
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def __len__(self):
+        return len(self.entries)
+
+class ServiceMetrics:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.renders = 0
+        self.render_time = 0.0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def percentile(self, latencies, fraction):
+        if not latencies:
+            return 0.0
+        return latencies[min(int(fraction * len(latencies)), len(latencies) - 1)]
+
+    def to_dict(self):
+        # Latencies are in seconds over the last LATENCY_WINDOW render
+        # requests, throughput is per second since the service started
+        uptime = time.monotonic() - self.started
+        latencies = sorted(self.latencies)
+        return {
+            "uptime": uptime,
+            "requests": self.requests,
+            "errors": self.errors,
+            "cache_hits": self.cache_hits,
+            "coalesced": self.coalesced,
+            "renders": self.renders,
+            "requests_per_second": self.requests / uptime if uptime > 0 else 0.0,
+            "renders_per_second": self.renders / uptime if uptime > 0 else 0.0,
+            "mean_render_time": self.render_time / self.renders if self.renders else 0.0,
+            "latency": {
+                "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+                "p50": self.percentile(latencies, 0.5),
+                "p95": self.percentile(latencies, 0.95),
+                "p99": self.percentile(latencies, 0.99),
+                "max": latencies[-1] if latencies else 0.0
+            }
+        }
+
+class RenderService:
+    # Long running render server. POST /render takes engine parameters as
+    # JSON in the format of Engine.to_dict() (only banks and firing_order are
+    # required) and answers with the rendered .mr text. Renders run on a
+    # process pool, identical requests in flight share one render and the
+    # results of engines with a seed are kept in an LRU cache. GET /metrics
+    # reports counters, latency and throughput.
+    def __init__(self, workers=None, cache_entries=256, cache_bytes=64 * 1024 * 1024):
+        self.workers = workers
+        self.cache = LRUCache(cache_entries, cache_bytes)
+        self.metrics = ServiceMetrics()
+        self.in_flight = {}
+        self.executor = None
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=8765, path=None):
+        # Listens on a unix socket when path is given
+        # Forked workers would inherit the client sockets open when they are
+        # started and keep those connections from ever closing
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(WORKER_START_METHOD))
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle, path=path)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def serve_forever(self):
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    async def render(self, parameters):
+        key = request_key(parameters)
+        text = self.cache.get(key)
+        if text is not None:
+            self.metrics.cache_hits += 1
+            return text
+
+        future = self.in_flight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            start = time.monotonic()
+            future = loop.run_in_executor(self.executor, render_parameters, parameters)
+            future.add_done_callback(lambda done: self.finish(key, parameters, done, time.monotonic() - start))
+            self.in_flight[key] = future
+        else:
+            self.metrics.coalesced += 1
+
+        # Shielded so that a client hanging up does not cancel the render for
+        # everybody else waiting on it
+        return await asyncio.shield(future)
+
+    def finish(self, key, parameters, future, elapsed):
+        del self.in_flight[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        self.metrics.renders += 1
+        self.metrics.render_time += elapsed
+
+        # Without a seed every render is different, see Engine.seed
+        if parameters.get("seed") is not None:
+            self.cache.put(key, future.result())
+
+    async def dispatch(self, method, path, body):
+        if path == "/render":
+            if method != "POST":
+                return 405, "text/plain", "Use POST"
+
+            start = time.monotonic()
+            try:
+                parameters = json.loads(body)
+                if not isinstance(parameters, dict):
+                    raise ValueError("Expected a JSON object of engine parameters")
+                text = await self.render(parameters)
+            except (ValueError, KeyError, TypeError) as e:
+                self.metrics.errors += 1
+                return 400, "text/plain", "{}: {}\n".format(type(e).__name__, e)
+            except Exception as e:
+                self.metrics.errors += 1
+                return 500, "text/plain", "{}: {}\n".format(type(e).__name__, e)
+
+            self.metrics.latencies.append(time.monotonic() - start)
+            return 200, "text/plain", text
+        elif path == "/metrics":
+            metrics = self.metrics.to_dict()
+            metrics["cache_entries"] = len(self.cache)
+            metrics["cache_bytes"] = self.cache.size
+            metrics["in_flight"] = len(self.in_flight)
+            return 200, "application/json", json.dumps(metrics, indent=1)
+        elif path == "/health":
+            return 200, "text/plain", "ok\n"
+
+        return 404, "text/plain", "Not found\n"
+
+    async def handle(self, reader, writer):
+        # Minimal HTTP/1.1 with keep-alive, enough for curl, urllib and
+        # browser based tools
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                method, path, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY_SIZE:
+                    status, content_type, text = 413, "text/plain", "Request too large\n"
+                    headers["connection"] = "close"
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    self.metrics.requests += 1
+                    status, content_type, text = await self.dispatch(method, path.split("?")[0], body)
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                payload = text.encode("utf-8")
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: {}; charset=utf-8\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+                    status, REASONS[status], content_type, len(payload), "keep-alive" if keep_alive else "close").encode("latin-1"))
+                writer.write(payload)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(host, port, path, workers, cache_entries):
+    service = RenderService(workers, cache_entries)
+    server = await service.start(host, port, path)
+    for socket in server.sockets:
+        print("Listening on {}".format(socket.getsockname()))
+
+    try:
+        await service.serve_forever()
+    finally:
+        await service.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve engine renders over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", default=None, help="listen on a unix socket instead")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("--cache-entries", type=int, default=256)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.workers, args.cache_entries))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import csv
+import json
+import math
+
+import validation
+
+# Rough default coefficients, in CPU seconds per simulated second on a
+# typical desktop. They put the bundled I4 at about a third of real time and
+# the V69 at its hand tuned frequency at a little over half. Calibrate them
+# against your own machine with CostModel.calibrate().
+DEFAULT_COEFFICIENTS = {
+    "step": 5e-6,
+    "cylinder_fluid": 1e-6,
+    "cylinder_solver": 2e-8,
+    "bank": 2e-6,
+    "lobe_lookup": 1e-9,
+    "flow_lookup": 1e-9
+}
+
+FREQUENCY_CANDIDATES = [10000, 8000, 6000, 5000, 4000, 3000, 2400, 2000, 1600, 1200, 1000, 800, 600]
+SOLVER_STEP_CANDIDATES = [128, 64, 32, 16, 8, 4, 2]
+FLUID_STEP_CANDIDATES = [16, 8, 4, 2, 1]
+
+# Relative weight of each setting when ranking candidate settings by
+# fidelity, the simulation frequency matters the most for sound quality
+FIDELITY_WEIGHTS = {
+    "simulation_frequency": 1.0,
+    "fluid_simulation_steps": 0.5,
+    "max_sle_solver_steps": 0.25
+}
+
+TIMING_TABLE_COLUMNS = [
+    "cylinders",
+    "banks",
+    "simulation_frequency",
+    "max_sle_solver_steps",
+    "fluid_simulation_steps",
+    "intake_lobe_steps",
+    "exhaust_lobe_steps",
+    "intake_flow_samples",
+    "exhaust_flow_samples",
+    "seconds_per_second"
+]
+
+def writes_solver_steps(engine):
+    # Before engine-sim 0.1.13 the solver steps are not written and engine-sim
+    # runs with its defaults
+    return engine.engine_sim_version[2] >= validation.SOLVER_STEPS_VERSION
+
+def solver_steps(engine):
+    if writes_solver_steps(engine):
+        return {name: getattr(engine, name) for name in validation.DEFAULT_SOLVER_STEPS}
+    return dict(validation.DEFAULT_SOLVER_STEPS)
+
+def engine_parameters(engine):
+    steps = solver_steps(engine)
+    return {
+        "cylinders": engine.cylinder_count(),
+        "banks": len(engine.banks),
+        "simulation_frequency": engine.simulation_frequency,
+        "max_sle_solver_steps": steps["max_sle_solver_steps"],
+        "fluid_simulation_steps": steps["fluid_simulation_steps"],
+        "intake_lobe_steps": engine.intake_lobe_steps,
+        "exhaust_lobe_steps": engine.exhaust_lobe_steps,
+        "intake_flow_samples": len(engine.intake_flow),
+        "exhaust_flow_samples": len(engine.exhaust_flow)
+    }
+
+def features(parameters):
+    # Every term is linear in its coefficient so that the model can be fitted
+    # with ordinary least squares
+    frequency = parameters["simulation_frequency"]
+    cylinders = parameters["cylinders"]
+
+    return {
+        "step": frequency,
+        "cylinder_fluid": frequency * cylinders * parameters["fluid_simulation_steps"],
+        "cylinder_solver": frequency * cylinders * parameters["max_sle_solver_steps"],
+        "bank": frequency * parameters["banks"],
+        "lobe_lookup": frequency * cylinders * (
+            math.log2(max(parameters["intake_lobe_steps"], 2)) + math.log2(max(parameters["exhaust_lobe_steps"], 2))),
+        "flow_lookup": frequency * cylinders * (
+            math.log2(max(parameters["intake_flow_samples"], 2)) + math.log2(max(parameters["exhaust_flow_samples"], 2)))
+    }
+
+def solve(matrix, vector):
+    # Gaussian elimination with partial pivoting, the systems solved here are
+    # only a handful of rows
+    n = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(n)]
+
+    for column in range(n):
+        pivot = max(range(column, n), key=lambda row: abs(rows[row][column]))
+        if abs(rows[pivot][column]) < 1e-12:
+            raise ValueError("Timing table does not determine every coefficient")
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+
+        for row in range(n):
+            if row == column:
+                continue
+            factor = rows[row][column] / rows[column][column]
+            for k in range(column, n + 1):
+                rows[row][k] -= factor * rows[column][k]
+
+    return [rows[i][n] / rows[i][i] for i in range(n)]
+
+class CostModel:
+    def __init__(self, coefficients=None):
+        self.coefficients = dict(DEFAULT_COEFFICIENTS)
+        if coefficients is not None:
+            self.coefficients.update(coefficients)
+
+    def estimate_parameters(self, parameters):
+        terms = features(parameters)
+        return sum(self.coefficients[name] * value for name, value in terms.items())
+
+    def estimate(self, engine):
+        return self.estimate_parameters(engine_parameters(engine))
+
+    def calibrate(self, rows, ridge=1e-6):
+        # rows are dicts with the TIMING_TABLE_COLUMNS, seconds_per_second being
+        # the measured CPU time per simulated second. Columns are normalized
+        # before solving the (slightly regularized) normal equations as the
+        # features differ by many orders of magnitude.
+        names = list(DEFAULT_COEFFICIENTS)
+        samples = [features(row) for row in rows]
+        targets = [float(row["seconds_per_second"]) for row in rows]
+        if not samples:
+            raise ValueError("Timing table is empty")
+
+        scales = []
+        for name in names:
+            scale = max(abs(sample[name]) for sample in samples)
+            scales.append(scale if scale > 0 else 1.0)
+
+        x = [[sample[name] / scale for name, scale in zip(names, scales)] for sample in samples]
+
+        normal = [[sum(row[i] * row[j] for row in x) + (ridge if i == j else 0.0) for j in range(len(names))] for i in range(len(names))]
+        rhs = [sum(row[i] * target for row, target in zip(x, targets)) for i in range(len(names))]
+        solution = solve(normal, rhs)
+
+        # A negative cost makes no physical sense, such terms are dropped
+        for name, value, scale in zip(names, solution, scales):
+            self.coefficients[name] = max(value / scale, 0.0)
+
+        return self
+
+    def calibrate_from_file(self, fname):
+        with open(fname, 'r', newline='') as file:
+            rows = [{key: float(value) for key, value in row.items()} for row in csv.DictReader(file)]
+
+        return self.calibrate(rows)
+
+    def to_dict(self):
+        return dict(self.coefficients)
+
+    def save(self, fname):
+        with open(fname, 'w') as file:
+            json.dump(self.coefficients, file, indent=4)
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname, 'r') as file:
+            return cls(json.load(file))
+
+def fidelity(settings):
+    return sum(weight * math.log(settings[name]) for name, weight in FIDELITY_WEIGHTS.items())
+
+def tune(engine, budget, model=None):
+    # Picks the highest fidelity combination of simulation frequency and
+    # solver steps whose estimated cost fits into the budget, never going above
+    # the settings already on the engine. Before engine-sim 0.1.13 only the
+    # frequency is tuned, the solver steps cannot be changed.
+    if model is None:
+        model = CostModel()
+
+    parameters = engine_parameters(engine)
+    tune_steps = writes_solver_steps(engine)
+
+    def candidates(values, current):
+        if not tune_steps and values is not FREQUENCY_CANDIDATES:
+            return [current]
+        return [value for value in values if value < current] + [current]
+
+    best = None
+    for frequency in candidates(FREQUENCY_CANDIDATES, engine.simulation_frequency):
+        for max_sle_solver_steps in candidates(SOLVER_STEP_CANDIDATES, parameters["max_sle_solver_steps"]):
+            for fluid_simulation_steps in candidates(FLUID_STEP_CANDIDATES, parameters["fluid_simulation_steps"]):
+                settings = {
+                    "simulation_frequency": frequency,
+                    "max_sle_solver_steps": max_sle_solver_steps,
+                    "fluid_simulation_steps": fluid_simulation_steps
+                }
+                parameters.update(settings)
+
+                cost = model.estimate_parameters(parameters)
+                if cost > budget:
+                    continue
+
+                score = fidelity(settings)
+                if best is None or score > best[0]:
+                    best = (score, cost, settings)
+
+    if best is None:
+        raise ValueError("No simulation settings fit into a budget of {}".format(budget))
+
+    settings = best[2]
+    if not tune_steps:
+        settings = {"simulation_frequency": settings["simulation_frequency"]}
+
+    return settings, best[1]
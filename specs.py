@@ -0,0 +1,207 @@
+import argparse
+import copy
+import itertools
+import json
+import os
+import tomllib
+import traceback
+
+import batch
+import engine_generator
+import files
+import symmetry
+import validation
+
+MANIFEST = "manifest.json"
+
+def load_spec(path):
+    # A spec file holds an [engine] table in the format of Engine.to_dict(),
+    # where only banks and firing_order are required, an optional [grid]
+    # table of parameters to sweep, optional filters on the derived metrics
+    # of each point (see metrics.mask()) and an optional output file name
+    # template
+    if path.endswith(".toml"):
+        with open(path, 'rb') as file:
+            return tomllib.load(file)
+    elif path.endswith(".json"):
+        with open(path) as file:
+            return json.load(file)
+    else:
+        raise ValueError("Unsupported spec file '{}', expected .toml or .json".format(path))
+
+def axis_values(axis):
+    # An axis is a list of values or a {start, stop, step} range where stop
+    # is excluded
+    if isinstance(axis, dict):
+        start, stop, step = axis["start"], axis["stop"], axis.get("step", 1)
+        if step <= 0:
+            raise ValueError("Grid step must be positive")
+
+        values = []
+        while start + len(values) * step < stop - 1e-9 * step:
+            values.append(start + len(values) * step)
+        return values
+
+    return list(axis)
+
+def set_path(parameters, path, value):
+    # "vehicle.mass" sets parameters["vehicle"]["mass"]
+    names = path.split(".")
+    for name in names[:-1]:
+        parameters = parameters.setdefault(name, {})
+    parameters[names[-1]] = value
+
+def expand(spec, stem):
+    # Yields (name, engine parameters) for every point of the spec's grid.
+    # Names are formatted from the output template with the spec file stem,
+    # the point index and the grid values ("vehicle.mass" as vehicle_mass).
+    # Points rejected by the spec's filter are skipped without creating any
+    # engine, the others keep their index.
+    if "engine" not in spec:
+        raise ValueError("Spec '{}' has no engine table".format(stem))
+
+    axes = {path: axis_values(axis) for path, axis in spec.get("grid", {}).items()}
+    template = spec.get("output", "{stem}_{index}" if axes else "{stem}")
+
+    if "filter" in spec:
+        # Needs NumPy, only imported for specs with a filter
+        import metrics
+
+        keep = metrics.grid_mask(engine_generator.Engine.from_dict(spec["engine"]), axes, spec["filter"])
+        points = metrics.grid_points(axes, keep.nonzero()[0])
+    else:
+        points = enumerate(symmetry.grid(axes))
+
+    for index, point in points:
+        parameters = copy.deepcopy(spec["engine"])
+        for path, value in point.items():
+            set_path(parameters, path, value)
+
+        fields = {path.replace(".", "_"): value for path, value in point.items()}
+        yield template.format(stem=stem, index=index, **fields), parameters
+
+def expand_files(paths):
+    for path in paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        yield from expand(load_spec(path), stem)
+
+def load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST)
+    fd, temp_path = files.temp_file_for(path)
+    with os.fdopen(fd, 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(temp_path, path)
+
+def _render_variants(chunk, output_dir):
+    results = []
+    for index, name, parameters in chunk:
+        try:
+            engine = engine_generator.Engine.from_dict(parameters)
+            engine.generate()
+            path = os.path.join(output_dir, name + ".mr")
+            engine.write_to_file(path, atomic=True)
+            results.append(batch.BatchResult(index, output=path))
+        except Exception:
+            results.append(batch.BatchResult(index, error=traceback.format_exc()))
+
+    return results
+
+class RenderSummary:
+    def __init__(self):
+        self.rendered = 0
+        self.unchanged = 0
+        self.failed = []
+
+def render(paths, output_dir, workers=None, chunksize=4, force=False, summary=None):
+    # Renders every variant of the given spec files into output_dir. The spec
+    # hash of each output is kept in output_dir/manifest.json and variants
+    # whose hash and output file are unchanged are skipped, so an interrupted
+    # run picks up where it stopped. Variants that fail validation are not
+    # sent to the workers. Yields a BatchResult per rendered or failed file.
+    if summary is None:
+        summary = RenderSummary()
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+    pending = {}
+    rejected = []
+
+    def variants():
+        names = set()
+        for index, (name, parameters) in enumerate(expand_files(paths)):
+            if name in names:
+                raise ValueError("Output name '{}' is used twice".format(name))
+            names.add(name)
+
+            # A malformed point only rejects itself, as in
+            # validation.validate_specs()
+            try:
+                engine = engine_generator.Engine.from_dict(parameters)
+            except (ValueError, KeyError, TypeError) as e:
+                pending[index] = (name, None)
+                rejected.append(batch.BatchResult(index, error=str(validation.Problem("spec", "engine", str(e)))))
+                continue
+
+            spec_hash = engine.spec_hash()
+            problems = validation.errors(validation.validate(engine))
+            if problems:
+                pending[index] = (name, spec_hash)
+                rejected.append(batch.BatchResult(index, error="\n".join(str(problem) for problem in problems)))
+                continue
+
+            path = os.path.join(output_dir, name + ".mr")
+            if not force and manifest.get(name) == spec_hash and os.path.exists(path):
+                summary.unchanged += 1
+                continue
+
+            pending[index] = (name, spec_hash)
+            yield index, name, parameters
+
+    try:
+        # rejected is complete once the workers have drained variants()
+        results = itertools.chain(batch.map_chunks(_render_variants, variants(), (output_dir,), workers, chunksize, ordered=False, on_error=batch.failed_chunk), rejected)
+        for count, result in enumerate(results, 1):
+            name, spec_hash = pending.pop(result.index)
+            if result.ok:
+                manifest[name] = spec_hash
+                summary.rendered += 1
+            else:
+                manifest.pop(name, None)
+                summary.failed.append(name)
+
+            # Saved every so often so that progress survives a crash
+            if count % 64 == 0:
+                save_manifest(output_dir, manifest)
+
+            yield result
+    finally:
+        save_manifest(output_dir, manifest)
+
+def main():
+    parser = argparse.ArgumentParser(description="Render engines from JSON/TOML spec files")
+    parser.add_argument("specs", nargs="+")
+    parser.add_argument("-o", "--output-dir", default=".")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=4)
+    parser.add_argument("--force", action="store_true", help="re-render unchanged variants too")
+    args = parser.parse_args()
+
+    summary = RenderSummary()
+    for result in render(args.specs, args.output_dir, args.workers, args.chunksize, args.force, summary):
+        if result.ok:
+            print(result.output)
+        else:
+            print("Variant failed:\n{}".format(result.error))
+
+    print("{} rendered, {} unchanged, {} failed".format(summary.rendered, summary.unchanged, len(summary.failed)))
+    return 1 if summary.failed else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
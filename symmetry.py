@@ -0,0 +1,112 @@
+import hashlib
+import itertools
+import json
+
+def transformed_banks(banks, mirror, reverse, ignore_flip):
+    # Each bank as (angle, flip, cylinders in crank order) after mirroring the
+    # engine left to right and/or front to back
+    result = []
+    for bank in banks:
+        angle = -bank.bank_angle if mirror else bank.bank_angle
+        flip = None if ignore_flip else (bank.flip != mirror)
+        cylinders = tuple(reversed(bank.cylinders)) if reverse else tuple(bank.cylinders)
+        result.append((angle + 0.0, flip, cylinders))
+
+    return result
+
+def bank_orders(banks):
+    # Banks sorted by angle, every ordering of banks that share an angle is
+    # tried as they cannot be told apart otherwise
+    banks = sorted(banks, key=lambda bank: (bank[0], bank[1] is True, len(bank[2])))
+    groups = [list(group) for _, group in itertools.groupby(banks, key=lambda bank: (bank[0], bank[1], len(bank[2])))]
+    for choice in itertools.product(*[itertools.permutations(group) for group in groups]):
+        yield [bank for group in choice for bank in group]
+
+def encode(banks, firing_order):
+    # Cylinders are relabelled by bank and position in bank and the firing
+    # order is rotated to start at the first cylinder, rotating the firing
+    # order only moves the crank's zero reference
+    labels = {}
+    for bank in banks:
+        for cylinder in bank[2]:
+            labels.setdefault(cylinder, len(labels))
+
+    relabelled = [labels[cylinder] for cylinder in firing_order]
+    start = relabelled.index(0) if 0 in relabelled else 0
+    rotated = tuple(relabelled[start:] + relabelled[:start])
+
+    return tuple((angle, flip, len(cylinders)) for angle, flip, cylinders in banks), rotated
+
+def canonical_form(banks, firing_order, ignore_flip=True):
+    # Smallest encoding over relabelled cylinders, firing order rotations,
+    # bank reordering and left/right and front/back mirror images. Engines
+    # with the same canonical form are the same engine. flip only changes
+    # how engine-sim draws a bank and is ignored unless asked otherwise.
+    best = None
+    for mirror in (False, True):
+        for reverse in (False, True):
+            for ordered in bank_orders(transformed_banks(banks, mirror, reverse, ignore_flip)):
+                candidate = encode(ordered, firing_order)
+                if best is None or candidate < best:
+                    best = candidate
+
+    return best
+
+def canonical_key(engine, ignore_flip=True):
+    # Digest of the canonical geometry plus every other parameter
+    parameters = engine.to_dict()
+    del parameters["banks"]
+    del parameters["firing_order"]
+
+    spec = {
+        "geometry": canonical_form(engine.banks, engine.firing_order, ignore_flip),
+        "parameters": parameters
+    }
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8")).digest()
+
+def firing_orders(cylinders):
+    # Every firing order of the given cylinders up to rotation, lazily
+    cylinders = list(cylinders)
+    if not cylinders:
+        return
+
+    first, rest = cylinders[0], cylinders[1:]
+    for permutation in itertools.permutations(rest):
+        yield [first] + list(permutation)
+
+def grid(axes):
+    # Lazy cartesian product. Unlike itertools.product no axis is copied into
+    # memory, so axes must be re-iterable (lists, ranges) or callables that
+    # return a fresh iterable each time, e.g. lambda: firing_orders(range(8))
+    names = list(axes)
+
+    def values(name):
+        axis = axes[name]
+        return axis() if callable(axis) else axis
+
+    def expand(index, point):
+        if index == len(names):
+            yield dict(point)
+            return
+
+        for value in values(names[index]):
+            point[names[index]] = value
+            yield from expand(index + 1, point)
+
+    yield from expand(0, {})
+
+def sweep(build, axes, ignore_flip=True, seen=None):
+    # Yields (parameters, engine) for one representative of every class of
+    # equivalent engines in the grid, build(**parameters) creates an engine
+    # for a grid point. Only digests of the classes seen so far are kept.
+    if seen is None:
+        seen = set()
+
+    for parameters in grid(axes):
+        engine = build(**parameters)
+        key = canonical_key(engine, ignore_flip)
+        if key in seen:
+            continue
+
+        seen.add(key)
+        yield parameters, engine
@@ -0,0 +1,57 @@
+import functools
+import itertools
+import string
+
+# Rows rendered per fragment by Template.rows(), keeps the fragments small
+# enough for streamed output while amortizing the join
+ROW_BATCH = 512
+
+class Template:
+    # A str.format() template compiled once into an f-string function, so
+    # rendering does not parse the template again. Only plain fields ("{}",
+    # "{0}", "{:.4f}", "{!r}") are supported. Output is identical to
+    # text.format(*values).
+    def __init__(self, text):
+        self.text = text
+
+        pieces = []
+        count = 0
+        automatic = 0
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if literal:
+                pieces.append("f" + repr(literal.replace("{", "{{").replace("}", "}}")))
+            if field is None:
+                continue
+
+            if field == "":
+                index = automatic
+                automatic += 1
+            elif field.isdigit():
+                index = int(field)
+            else:
+                raise ValueError("Unsupported template field '{}'".format(field))
+
+            count = max(count, index + 1)
+            pieces.append("f'{{a{}{}{}}}'".format(index, "!" + conversion if conversion else "", ":" + spec if spec else ""))
+
+        self.fields = count
+        arguments = ", ".join("a{}".format(index) for index in range(count))
+        source = "lambda {}: {}".format(arguments, " ".join(pieces) if pieces else "''")
+        self.render = eval(source, {})
+
+    def __call__(self, *values):
+        return self.render(*values)
+
+    def rows(self, *columns):
+        # Yields the template rendered for every row of the given columns,
+        # ROW_BATCH rows per fragment
+        rows = map(self.render, *columns)
+        while True:
+            batch = "".join(itertools.islice(rows, ROW_BATCH))
+            if not batch:
+                return
+            yield batch
+
+@functools.lru_cache(maxsize=None)
+def compile_template(text):
+    return Template(text)
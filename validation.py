@@ -0,0 +1,228 @@
+import numbers
+
+# Checks run before anything is rendered. The generator indexes rod journals
+# and wires by cylinder number, so the banks must hold the cylinders
+# 0..n-1 exactly once between them and the firing order must fire each of
+# them exactly once. Every check is O(cylinders).
+
+# engine-sim version (third component) from which the solver steps are
+# written, see Engine.iter_engine()
+SOLVER_STEPS_VERSION = 13
+
+DEFAULT_SOLVER_STEPS = {
+    "fluid_simulation_steps": 4,
+    "max_sle_solver_steps": 128
+}
+
+POSITIVE_PARAMETERS = [
+    "stroke",
+    "bore",
+    "rod_length",
+    "redline",
+    "simulation_frequency",
+    "timing_curve_step"
+]
+
+# Cylinder numbers listed in a problem message, Problem.values has them all
+MAX_LISTED = 8
+
+class Problem:
+    # One validation problem. code identifies the kind of problem, path the
+    # parameter at fault ("banks[1].cylinders"), values the offending values.
+    # Warnings are reported but do not stop a render.
+    __slots__ = ("code", "path", "message", "values", "severity")
+
+    def __init__(self, code, path, message, values=(), severity="error"):
+        self.code = code
+        self.path = path
+        self.message = message
+        self.values = list(values)
+        self.severity = severity
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __str__(self):
+        return "{}: {}".format(self.path, self.message)
+
+    def __repr__(self):
+        return "Problem({!r}, {!r}, {!r})".format(self.code, self.path, self.message)
+
+class ValidationError(ValueError):
+    def __init__(self, problems):
+        super().__init__("; ".join(str(problem) for problem in problems))
+        self.problems = problems
+
+    def __reduce__(self):
+        # Raised in pool workers, so it must be rebuilt from the problems
+        # rather than from the message
+        return (ValidationError, (self.problems,))
+
+def listing(values):
+    text = ", ".join(str(value) for value in values[:MAX_LISTED])
+    if len(values) > MAX_LISTED:
+        text += " and {} more".format(len(values) - MAX_LISTED)
+    return text
+
+def is_integer(value):
+    # The ABC check is slow, plain ints take the fast path
+    return type(value) is int or (isinstance(value, numbers.Integral) and not isinstance(value, bool))
+
+def is_positive(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool) and value > 0
+
+def integer_types(values):
+    # Fast check that every value is an integer, non-integers are searched
+    # for one by one only if it fails
+    types = set(map(type, values))
+    return types <= {int} or all(is_integer(value) for value in values)
+
+def duplicates(values):
+    seen = set()
+    repeated = []
+    for value in values:
+        if value in seen:
+            repeated.append(value)
+        seen.add(value)
+    return repeated
+
+def check_geometry(engine):
+    # Bulk set operations in the common case of valid input, the slower
+    # per-cylinder passes only run to report what is wrong
+    problems = []
+    if not engine.banks:
+        problems.append(Problem("no_banks", "banks", "Engine has no banks"))
+
+    all_cylinders = set()
+    for bank_index, bank in enumerate(engine.banks):
+        path = "banks[{}].cylinders".format(bank_index)
+        cylinders = bank.cylinders
+        if not cylinders:
+            problems.append(Problem("empty_bank", path, "Bank has no cylinders"))
+
+        if not integer_types(cylinders):
+            not_integers = [value for value in cylinders if not is_integer(value)]
+            problems.append(Problem("cylinder_type", path, "Cylinders {} are not integers".format(listing([repr(value) for value in not_integers])), not_integers))
+            cylinders = [value for value in cylinders if is_integer(value)]
+
+        bank_cylinders = set(cylinders)
+        if len(bank_cylinders) != len(cylinders):
+            repeated = duplicates(cylinders)
+            problems.append(Problem("repeated_cylinder", path, "Cylinders {} appear more than once".format(listing(repeated)), repeated))
+
+        shared = bank_cylinders & all_cylinders
+        if shared:
+            shared = sorted(shared)
+            problems.append(Problem("shared_cylinder", path, "Cylinders {} are also in an earlier bank".format(listing(shared)), shared))
+
+        all_cylinders |= bank_cylinders
+
+    # Distinct integers numbered 0 to n-1 if the smallest is 0 and the
+    # largest n-1
+    n_cylinders = len(all_cylinders)
+    if all_cylinders and (min(all_cylinders) != 0 or max(all_cylinders) != n_cylinders - 1):
+        out_of_range = sorted(cylinder for cylinder in all_cylinders if not 0 <= cylinder < n_cylinders)
+        problems.append(Problem(
+            "cylinder_numbering", "banks",
+            "Cylinders must be numbered 0 to {}, found {}".format(n_cylinders - 1, listing(out_of_range)), out_of_range))
+
+    firing_order = engine.firing_order
+    if len(firing_order) != n_cylinders:
+        problems.append(Problem(
+            "firing_order_length", "firing_order",
+            "Firing order has {} entries for {} cylinders".format(len(firing_order), n_cylinders)))
+
+    if not integer_types(firing_order):
+        not_integers = [value for value in firing_order if not is_integer(value)]
+        problems.append(Problem("cylinder_type", "firing_order", "Cylinders {} are not integers".format(listing([repr(value) for value in not_integers])), not_integers))
+        firing_order = [value for value in firing_order if is_integer(value)]
+
+    fired = set(firing_order)
+    if len(fired) != len(firing_order):
+        repeated = duplicates(firing_order)
+        problems.append(Problem("firing_order_repeated", "firing_order", "Cylinders {} fire more than once".format(listing(repeated)), repeated))
+
+    if fired != all_cylinders:
+        unknown = sorted(fired - all_cylinders)
+        if unknown:
+            problems.append(Problem("firing_order_unknown", "firing_order", "Cylinders {} are not in any bank".format(listing(unknown)), unknown))
+
+        never_fired = sorted(all_cylinders - fired)
+        if never_fired:
+            problems.append(Problem("firing_order_missing", "firing_order", "Cylinders {} never fire".format(listing(never_fired)), never_fired))
+
+    return problems
+
+def check_settings(engine):
+    problems = []
+
+    version = engine.engine_sim_version
+    if not isinstance(version, (list, tuple)) or len(version) != 4 or not all(is_integer(part) for part in version):
+        problems.append(Problem("engine_sim_version", "engine_sim_version", "Expected 4 integers, got {!r}".format(version)))
+    elif version[2] >= SOLVER_STEPS_VERSION:
+        for name in DEFAULT_SOLVER_STEPS:
+            if not is_integer(getattr(engine, name)) or getattr(engine, name) <= 0:
+                problems.append(Problem("solver_steps", name, "Must be a positive integer, got {!r}".format(getattr(engine, name))))
+    else:
+        for name, default in DEFAULT_SOLVER_STEPS.items():
+            if getattr(engine, name) != default:
+                problems.append(Problem(
+                    "version_gated", name,
+                    "Ignored before engine-sim 0.1.{}, engine_sim_version is {}".format(SOLVER_STEPS_VERSION, ".".join(str(part) for part in version)),
+                    severity="warning"))
+
+    # The per-cylinder streams are keyed on the seed's bits, see
+    # cylinder_random.stream_key()
+    if engine.seed is not None and not is_integer(engine.seed):
+        problems.append(Problem("seed", "seed", "Must be an integer or None, got {!r}".format(engine.seed)))
+
+    for name in POSITIVE_PARAMETERS:
+        if not is_positive(getattr(engine, name)):
+            problems.append(Problem("not_positive", name, "Must be a positive number, got {!r}".format(getattr(engine, name))))
+
+    bounds = engine.sound_attenuation_range
+    if len(bounds) != 2 or not all(isinstance(bound, numbers.Real) for bound in bounds):
+        problems.append(Problem("range", "sound_attenuation_range", "Expected [low, high], got {!r}".format(bounds)))
+    elif bounds[0] > bounds[1]:
+        problems.append(Problem("range", "sound_attenuation_range", "Lower bound {} is above upper bound {}".format(*bounds)))
+
+    if not engine.transmission.gears:
+        problems.append(Problem("no_gears", "transmission.gears", "Transmission has no gears"))
+
+    return problems
+
+def validate(engine):
+    # Every problem with the engine, errors and warnings
+    return check_geometry(engine) + check_settings(engine)
+
+def errors(problems):
+    return [problem for problem in problems if problem.severity == "error"]
+
+def check(engine):
+    problems = errors(validate(engine))
+    if problems:
+        raise ValidationError(problems)
+
+def validate_specs(specs):
+    # Splits engines or engine parameter dicts (Engine.to_dict() format) into
+    # the valid engines and (index, problems) for every invalid spec, without
+    # rendering anything
+    import engine_generator
+
+    engines = []
+    rejected = []
+    for index, spec in enumerate(specs):
+        if isinstance(spec, dict):
+            try:
+                spec = engine_generator.Engine.from_dict(spec)
+            except (ValueError, KeyError, TypeError) as e:
+                rejected.append((index, [Problem("spec", "engine", str(e))]))
+                continue
+
+        problems = errors(validate(spec))
+        if problems:
+            rejected.append((index, problems))
+        else:
+            engines.append(spec)
+
+    return engines, rejected